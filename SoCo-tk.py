@@ -1,70 +1,707 @@
 #!/usr/bin/env python
 
+import time
+STARTUP_TIME = time.time()
+
+import sys
+import __builtin__
+
+# With --profile-startup every module loaded before the window shows is
+# timed, the time of nested imports is included in their importer's
+IMPORT_TIMES = None
+if '--profile-startup' in sys.argv:
+    IMPORT_TIMES = []
+    _builtinImport = __builtin__.__import__
+
+    def _timedImport(name, *args, **kwargs):
+        if name in sys.modules:
+            return _builtinImport(name, *args, **kwargs)
+
+        started = time.time()
+        try:
+            return _builtinImport(name, *args, **kwargs)
+        finally:
+            IMPORT_TIMES.append((time.time() - started, name))
+
+    __builtin__.__import__ = _timedImport
+
 import Tkinter as tk
 import logging, traceback
 logging.basicConfig(format='%(asctime)s %(levelname)10s: %(message)s', level = logging.DEBUG)
 
 import tkMessageBox
-import urllib
-import base64
-import platform, os
-import StringIO as sio
-
-import sqlite3 as sql
-import contextlib as clib
-
-try:
-    import soco
-except:
-    logging.warning('Could not import soco, trying from local file')
+import tkFileDialog
+import tkFont
+import Queue
+import bisect
+import collections
+import difflib
+
+from soco_controller import SonosController, WrappedSoCo, Task, WorkerPool, EventListener, \
+     QueueContent, HTTP_POOL, TIMINGS, TIMING_BUCKETS, USER_DATA, findSoCo, loadImaging, openImage, timed
+
+if not findSoCo():
+    tkMessageBox.showerror(title = 'SoCo',
+                           message = 'Could not find SoCo library, make sure you have installed SoCo!',
+                           parent = None)
+    exit()
+
+ImageTk = None
+_imageTkFailed = False
+
+def loadImageTk():
+    global ImageTk, _imageTkFailed
+    if ImageTk is not None:
+        return True
+    if _imageTkFailed or not loadImaging():
+        return False
+
     try:
-        import sys
-        sys.path.append('./SoCo')
-        import soco
+        from PIL import ImageTk as imageTkModule
+        ImageTk = imageTkModule
+        return True
     except:
-        logging.error('Could not find SoCo library')
-        soco = None
-        tkMessageBox.showerror(title = 'SoCo',
-                               message = 'Could not find SoCo library, make sure you have installed SoCo!',
-                               parent = None)
-        exit()
-
-try:
-    from PIL import Image, ImageTk
-except:
-    logging.error('Could not import PIL')
-    logging.error(traceback.format_exc())
-    ImageTk = None
-    Image = None
-
-USER_DATA = None
-
-if platform.system() == 'Windows':
-    USER_DATA = os.path.join(os.getenv('APPDATA'), 'SoCo-Tk')
-elif platform.system() == 'Linux':
-    USER_DATA = '%(sep)shome%(sep)s%(name)s%(sep)s.config%(sep)sSoCo-Tk%(sep)s' % {
-    'sep' : os.sep,
-    'name': os.environ['LOGNAME']
-    }    
-##elif platform.system() == 'Mac':
-##    pass
-
-
-class WrappedSoCo(soco.SoCo):
-    def __init__(self, ip, get_info = True):
-        soco.SoCo.__init__(self, ip)
-        if get_info: self.get_speaker_info()
-        
-        invalid_keys = [key for key, value in self.speaker_info.items() if value is None]
-        for key in invalid_keys:
-            del self.speaker_info[key]
-        
-    def __str__(self):
-        name = self.speaker_info['zone_name']
-        if name is None:
-            name = 'Unnamed'
-        return name
+        logging.error('Could not import PIL.ImageTk')
+        logging.error(traceback.format_exc())
+        _imageTkFailed = True
+        return False
+
+def makePhotoImage(image):
+    if not loadImageTk():
+        raise ImportError('PIL is not available')
+
+    with TIMINGS.measure('tk.photo'):
+        return ImageTk.PhotoImage(image = image)
+
+def reportImportProfile(firstPaint, limit = 25):
+    # Stops timing imports and prints the slowest ones
+    if IMPORT_TIMES is None:
+        return
+
+    __builtin__.__import__ = _builtinImport
+    print 'First window after %.1f ms, %d module(s) imported before' % (
+        firstPaint * 1000, len(IMPORT_TIMES))
+    for elapsed, name in sorted(IMPORT_TIMES, reverse = True)[:limit]:
+        print '%8.1f ms  %s' % (elapsed * 1000, name)
+
+
+# Runs blocking calls on a bounded WorkerPool and hands the results
+# back to the Tk thread, which drains them through after()
+class Dispatcher(object):
+    def __init__(self, widget, size = 4, interval = 10, budget = 0.010):
+        self.__widget = widget
+        self.__pool = WorkerPool(size)
+        self.__results = Queue.Queue()
+        self.__posted = Queue.Queue()
+        self.__pending = 0
+        self.__afterId = None
+
+        self.interval = interval
+        self.budget = budget
+
+        # Set while other threads may post(), they cannot wake Tk up
+        # themselves so we keep looking at this interval
+        self.idleInterval = None
+
+    def call(self, func, args = (), kwargs = None, callback = None, errback = None):
+        task = Task(func, args, kwargs, callback, errback)
+        task.done = self.__results.put
+        if TIMINGS.enabled:
+            task.queued = time.time()
+
+        self.__pending += 1
+        self.__pool.submit(task)
+        self.__schedule()
+        return task
+
+    def post(self, func, args = ()):
+        # Safe to call from any thread, func runs on the Tk thread
+        self.__posted.put(Task(func, args))
+
+    def startIdlePolling(self, interval = 50):
+        self.idleInterval = interval
+        self.__schedule()
+
+    def shutdown(self, timeout = None):
+        self.idleInterval = None
+        if self.__afterId is not None:
+            self.__widget.after_cancel(self.__afterId)
+            self.__afterId = None
+        self.__pool.shutdown(timeout)
+
+    def __schedule(self):
+        if self.__afterId is None:
+            interval = self.interval if self.__pending > 0 else self.idleInterval
+            self.__afterId = self.__widget.after(interval or self.interval, self.__poll)
+
+    def __poll(self):
+        self.__afterId = None
+
+        # Deliver as many results as fit in the budget, the rest waits
+        # for the next tick so a burst never stalls the event loop
+        deadline = time.time() + self.budget
+        while time.time() < deadline:
+            try:
+                task = self.__results.get_nowait()
+            except Queue.Empty:
+                break
+
+            self.__pending -= 1
+            started = time.time()
+            failed = False
+            try:
+                task.deliver()
+            except:
+                failed = True
+                logging.error('Error delivering result of %s', task.func)
+                logging.error(traceback.format_exc())
+
+            # How long results wait for the Tk thread and how long it
+            # then spends on them
+            if TIMINGS.enabled and task.queued is not None:
+                TIMINGS.record('ui.wait', started - task.queued)
+                TIMINGS.record('ui.callback', time.time() - started, failed = failed)
+
+        while time.time() < deadline:
+            try:
+                task = self.__posted.get_nowait()
+            except Queue.Empty:
+                break
+
+            task.run()
+            task.deliver()
+
+        if self.__pending > 0 or\
+           self.idleInterval is not None or\
+           not self.__posted.empty():
+            self.__schedule()
+
+
+# Sends volume changes without ever queueing up stale ones. At most one
+# request per speaker is in flight and at most one per minInterval is
+# started, values coming in meanwhile replace each other so only the
+# latest one is sent once the speaker has answered
+class VolumeSender(object):
+    def __init__(self, dispatcher, widget, minInterval = 0.1):
+        self.__dispatcher = dispatcher
+        self.__widget = widget
+        self.minInterval = minInterval
+
+        self.__latest = {}
+        self.__inFlight = set()
+        self.__scheduled = set()
+        self.__lastSent = {}
+
+    def send(self, speaker, volume):
+        self.__latest[speaker] = volume
+        self.__flush(speaker)
+
+    def busy(self, speaker):
+        return speaker in self.__latest or speaker in self.__inFlight
+
+    def __flush(self, speaker):
+        if speaker in self.__inFlight or\
+           speaker in self.__scheduled or\
+           speaker not in self.__latest:
+            return
+
+        wait = self.minInterval - (time.time() - self.__lastSent.get(speaker, 0))
+        if wait > 0:
+            self.__scheduled.add(speaker)
+            self.__widget.after(int(wait * 1000) + 1, lambda: self.__scheduledFlush(speaker))
+            return
+
+        volume = self.__latest.pop(speaker)
+        self.__inFlight.add(speaker)
+        self.__lastSent[speaker] = time.time()
+
+        logging.debug('Changing volume of "%s" to: %d', speaker, volume)
+        self.__dispatcher.call(speaker.volume,
+                               (volume,),
+                               callback = lambda result: self.__sent(speaker),
+                               errback = lambda errmsg: self.__failed(speaker, errmsg))
+
+    def __scheduledFlush(self, speaker):
+        self.__scheduled.discard(speaker)
+        self.__flush(speaker)
+
+    def __sent(self, speaker):
+        self.__inFlight.discard(speaker)
+        self.__flush(speaker)
+
+    def __failed(self, speaker, errmsg):
+        logging.error('Could not change volume of "%s"', speaker)
+        logging.error(errmsg)
+        self.__sent(speaker)
+
+
+# Keeps the last few ready to show PhotoImages around, keyed by
+# (art hash, size) with track uris as aliases, so going back to a
+# speaker or track shown recently needs no database lookup or decode
+class PhotoImageCache(object):
+    def __init__(self, max_bytes = 8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self.__images = collections.OrderedDict()
+        self.__aliases = {}
+        self.__keyAliases = {}
+
+    def __len__(self):
+        return len(self.__images)
+
+    def get(self, key):
+        entry = self.__images.pop(key, None)
+        if entry is None:
+            return None
+
+        self.__images[key] = entry
+        return entry[0]
+
+    def getAlias(self, alias):
+        key = self.__aliases.get(alias)
+        if key is None:
+            return None
+
+        return self.get(key)
+
+    def put(self, key, photo, aliases = ()):
+        if key in self.__images:
+            self.__remove(key)
+
+        size = photo.width() * photo.height() * 4
+        self.__images[key] = (photo, size)
+        self.size += size
+
+        for alias in aliases:
+            if alias is None:
+                continue
+            self.addAlias(alias, key)
+
+        while self.size > self.max_bytes and len(self.__images) > 1:
+            oldest = next(iter(self.__images))
+            self.__remove(oldest)
+
+    def addAlias(self, alias, key):
+        if key not in self.__images:
+            return
+
+        previous = self.__aliases.get(alias)
+        if previous is not None and previous in self.__keyAliases:
+            self.__keyAliases[previous].discard(alias)
+
+        self.__aliases[alias] = key
+        self.__keyAliases.setdefault(key, set()).add(alias)
+
+    def clear(self):
+        self.__images.clear()
+        self.__aliases.clear()
+        self.__keyAliases.clear()
+        self.size = 0
+
+    def __remove(self, key):
+        photo, size = self.__images.pop(key)
+        self.size -= size
+
+        for alias in self.__keyAliases.pop(key, ()):
+            if self.__aliases.get(alias) == key:
+                del self.__aliases[alias]
+
+
+# A Listbox that only ever holds the rows fitting on screen. The items
+# live in a plain sequence and scrolling re-renders the visible window,
+# so the size of the queue does not matter to Tk. A filter (ascending
+# positions in items) shows only those items, selection and select()
+# still use positions in items
+class QueueView(tk.Frame):
+    def __init__(self, parent, labelFormat):
+        tk.Frame.__init__(self, parent)
+
+        self.labelFormat = labelFormat
+        self.items = []
+        self.filter = None
+        self.complete = True
+        self.loadMoreMargin = 20
+
+        self.onNeedMore = None
+        self.onActivate = None
+
+        self.__offset = 0
+        self.__rows = 1
+        self.__selected = None
+        self.__message = None
+        self.__shown = []
+
+        self._listbox = tk.Listbox(self,
+                                   selectmode = tk.BROWSE,
+                                   activestyle = 'none')
+        self._scrollbar = tk.Scrollbar(self, command = self.__scroll)
+
+        self.__lineHeight = tkFont.Font(font = self._listbox.cget('font')).metrics('linespace') + 1
+
+        self._listbox.bind('<<ListboxSelect>>', self.__listboxSelected)
+        self._listbox.bind('<Double-Button-1>', self.__activate)
+        self._listbox.bind('<Configure>', self.__resized)
+        self._listbox.bind('<MouseWheel>', self.__wheel)
+        self._listbox.bind('<Button-4>', self.__wheel)
+        self._listbox.bind('<Button-5>', self.__wheel)
+        self._listbox.bind('<B1-Motion>', lambda evt: 'break')
+
+        self._listbox.bind('<Up>', lambda evt: self.__moveSelection(-1))
+        self._listbox.bind('<Down>', lambda evt: self.__moveSelection(1))
+        self._listbox.bind('<Prior>', lambda evt: self.__moveSelection(-max(1, self.__rows - 1)))
+        self._listbox.bind('<Next>', lambda evt: self.__moveSelection(max(1, self.__rows - 1)))
+
+        self._listbox.grid(row = 0,
+                           column = 0,
+                           sticky = 'news')
 
+        self._scrollbar.grid(row = 0,
+                             column = 1,
+                             sticky = 'ns')
+
+        self.rowconfigure(0, weight = 1)
+        self.columnconfigure(0, weight = 1)
+
+    def setItems(self, items, complete = True):
+        self.items = items
+        self.filter = None
+        self.complete = complete
+        self.__offset = 0
+        self.__selected = None
+        self.__message = None
+        self.render()
+
+    def itemsChanged(self, complete = None):
+        if complete is not None:
+            self.complete = complete
+
+        self.__message = None
+        self.render()
+
+    def setFilter(self, positions, scrollToTop = True):
+        self.filter = positions
+        if scrollToTop:
+            self.__offset = 0
+        self.render()
+
+    def remap(self, mapIndex):
+        # Keeps selection and scroll position on the same items after
+        # the sequence has been edited in place, a filtered view keeps
+        # its rows until the filter is set again
+        if self.__selected is not None:
+            self.__selected = mapIndex(self.__selected)
+
+        if self.filter is None:
+            offset = mapIndex(self.__offset)
+            if offset is not None:
+                self.__offset = offset
+
+        self.render()
+
+    def showMessage(self, message):
+        self.__message = message
+        self.render()
+
+    def selectedIndex(self):
+        return self.__selected
+
+    def select(self, index, see = True):
+        self.__selected = index
+        if see and index is not None:
+            self.see(index)
+        else:
+            self.render()
+
+    def see(self, index):
+        row = self.__row(index)
+        if row is None:
+            pass
+        elif row < self.__offset:
+            self.__offset = row
+        elif row >= self.__offset + self.__rows:
+            self.__offset = row - self.__rows + 1
+
+        self.render()
+
+    @timed('tk.queue_render')
+    def render(self):
+        listbox = self._listbox
+        listbox.config(state = tk.NORMAL)
+
+        if self.__message is not None:
+            self.__showRows([self.__message])
+            listbox.config(state = tk.DISABLED)
+            self._scrollbar.set(0.0, 1.0)
+            return
+
+        total = self.__rowCount()
+        self.__offset = max(0, min(self.__offset, total - self.__rows))
+        end = min(total, self.__offset + self.__rows)
+
+        self.__showRows([self.labelFormat(self.items[self.__position(row)])
+                         for row in xrange(self.__offset, end)])
+
+        listbox.selection_clear(0, tk.END)
+        selectedRow = self.__row(self.__selected)
+        if selectedRow is not None and\
+           self.__offset <= selectedRow < end:
+            listbox.selection_set(selectedRow - self.__offset)
+
+        if total:
+            self._scrollbar.set(float(self.__offset) / total,
+                                float(end) / total)
+        else:
+            self._scrollbar.set(0.0, 1.0)
+
+        if not self.complete and\
+           end + self.loadMoreMargin >= total and\
+           self.onNeedMore:
+            self.onNeedMore()
+
+    def __showRows(self, labels):
+        # Only the rows that differ from what is on screen are touched
+        if labels == self.__shown:
+            return
+
+        listbox = self._listbox
+        matcher = difflib.SequenceMatcher(None, self.__shown, labels, autojunk = False)
+        for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+            if tag == 'equal':
+                continue
+
+            if i2 > i1:
+                listbox.delete(i1, i2 - 1)
+            if j2 > j1:
+                listbox.insert(i1, *labels[j1:j2])
+
+        self.__shown = labels
+
+    def __rowCount(self):
+        if self.filter is None:
+            return len(self.items)
+        return len(self.filter)
+
+    def __position(self, row):
+        if self.filter is None:
+            return row
+        return self.filter[row]
+
+    def __row(self, position):
+        # Row showing position, None if it is filtered out
+        if position is None or self.filter is None:
+            return position
+
+        row = bisect.bisect_left(self.filter, position)
+        if row < len(self.filter) and self.filter[row] == position:
+            return row
+        return None
+
+    def __scrollBy(self, rows):
+        self.__offset += rows
+        self.render()
+
+    def __scroll(self, *args):
+        if args[0] == 'moveto':
+            self.__offset = int(float(args[1]) * self.__rowCount())
+            self.render()
+        elif args[0] == 'scroll':
+            amount = int(args[1])
+            if args[2] == 'pages':
+                amount *= max(1, self.__rows - 1)
+            self.__scrollBy(amount)
+
+    def __wheel(self, evt):
+        if evt.num == 4 or evt.delta > 0:
+            self.__scrollBy(-3)
+        else:
+            self.__scrollBy(3)
+        return 'break'
+
+    def __moveSelection(self, delta):
+        if not self.__rowCount() or self.__message is not None:
+            return 'break'
+
+        row = self.__row(self.__selected)
+        if row is None:
+            row = self.__offset
+        else:
+            row = max(0, min(self.__rowCount() - 1, row + delta))
+
+        self.select(self.__position(row))
+        return 'break'
+
+    def __resized(self, evt):
+        rows = max(1, evt.height // self.__lineHeight)
+        if rows != self.__rows:
+            self.__rows = rows
+            self.render()
+
+    def __listboxSelected(self, evt):
+        selection = self._listbox.curselection()
+        if not selection or self.__message is not None:
+            return
+
+        self.__selected = self.__position(self.__offset + int(selection[0]))
+
+    def __activate(self, evt):
+        self.__listboxSelected(evt)
+        if self.onActivate and self.__selected is not None:
+            self.onActivate(evt)
+
+
+
+# Shows what Timings collected, one row per operation and per operation of
+# every speaker, refreshed while the window is open. The histogram column
+# has one character per TIMING_BUCKETS bucket, darker means more calls
+class DiagnosticsWindow(tk.Toplevel):
+    histogramChars = ' .:-=+*#@'
+
+    def __init__(self, parent, controller, speakerName, refreshInterval = 1000):
+        tk.Toplevel.__init__(self, parent)
+        self.title('Diagnostics')
+
+        self.refreshInterval = refreshInterval
+        self.__controller = controller
+        self.__speakerName = speakerName
+        self.__afterId = None
+        self.__enabled = tk.IntVar(value = int(TIMINGS.enabled))
+
+        toolbar = tk.Frame(self)
+        tk.Checkbutton(toolbar,
+                       text = 'Record timings',
+                       variable = self.__enabled,
+                       command = self.__toggle).pack(side = tk.LEFT)
+        tk.Button(toolbar,
+                  text = 'Reset',
+                  command = self.__reset).pack(side = tk.LEFT, padx = 5)
+        tk.Button(toolbar,
+                  text = 'Export...',
+                  command = self.__export).pack(side = tk.LEFT)
+        toolbar.grid(row = 0,
+                     column = 0,
+                     columnspan = 2,
+                     padx = 5,
+                     pady = 5,
+                     sticky = 'w')
+
+        self._text = tk.Text(self,
+                             width = 110,
+                             height = 30,
+                             wrap = tk.NONE,
+                             font = 'TkFixedFont')
+        self._scrollbar = tk.Scrollbar(self, command = self._text.yview)
+        self._text.config(yscrollcommand = self._scrollbar.set)
+
+        self._text.grid(row = 1,
+                        column = 0,
+                        sticky = 'news')
+        self._scrollbar.grid(row = 1,
+                             column = 1,
+                             sticky = 'ns')
+
+        self.rowconfigure(1, weight = 1)
+        self.columnconfigure(0, weight = 1)
+
+        self.refresh()
+
+    def destroy(self):
+        if self.__afterId is not None:
+            self.after_cancel(self.__afterId)
+            self.__afterId = None
+
+        tk.Toplevel.destroy(self)
+
+    def refresh(self):
+        if self.__afterId is not None:
+            self.after_cancel(self.__afterId)
+            self.__afterId = None
+
+        position = self._text.yview()[0]
+        self._text.config(state = tk.NORMAL)
+        self._text.delete('1.0', tk.END)
+        self._text.insert(tk.END, '\n'.join(self.__format(TIMINGS.getStats())))
+        self._text.config(state = tk.DISABLED)
+        self._text.yview_moveto(position)
+
+        self.__afterId = self.after(self.refreshInterval, self.refresh)
+
+    def __format(self, stats):
+        if not stats['enabled'] and not stats['operations']:
+            return ['Timings are not recorded, check "Record timings" to start.']
+
+        lines = ['Recorded for %.0f s, histogram buckets (ms): %s, slower' % (
+                     stats['duration'], ' '.join('<%d' % bound for bound in TIMING_BUCKETS)),
+                 '',
+                 self.__row('operation', 'count', 'errors', 'mean ms', 'p50', 'p95', 'max', 'histogram')]
+        lines.extend(self.__rows(stats['operations'], ''))
+
+        speakers = sorted(stats['speakers'].items(),
+                          key = lambda item: self.__speakerName(item[0]))
+        for ip, operations in speakers:
+            errors = sum(entry['errors'] for entry in operations.values())
+            lines.append('')
+            lines.append('%s (%s), %d error(s)' % (self.__speakerName(ip), ip, errors))
+            lines.extend(self.__rows(operations, '  '))
+
+        return lines
+
+    def __rows(self, operations, indent):
+        rows = []
+        for operation, entry in sorted(operations.items()):
+            rows.append(self.__row(indent + operation,
+                                   entry['count'],
+                                   entry['errors'],
+                                   '%.1f' % entry['mean_ms'],
+                                   '%.1f' % entry['p50_ms'],
+                                   '%.1f' % entry['p95_ms'],
+                                   '%.1f' % entry['max_ms'],
+                                   self.__histogram(entry['histogram'])))
+        return rows
+
+    def __row(self, *columns):
+        return '%-32s %7s %6s %9s %8s %8s %8s  %s' % columns
+
+    def __histogram(self, counts):
+        highest = max(counts)
+        if not highest:
+            return ''
+
+        scale = len(self.histogramChars) - 1
+        return '|%s|' % ''.join(self.histogramChars[(count * scale + highest - 1) // highest]
+                                for count in counts)
+
+    def __toggle(self):
+        TIMINGS.enabled = bool(self.__enabled.get())
+        try:
+            self.__controller.setConfig('timings_enabled', '1' if TIMINGS.enabled else '0')
+        except:
+            logging.error('Could not store timings setting')
+            logging.error(traceback.format_exc())
+
+        self.refresh()
+
+    def __reset(self):
+        TIMINGS.reset()
+        self.refresh()
+
+    def __export(self):
+        path = tkFileDialog.asksaveasfilename(parent = self,
+                                              title = 'Export timings',
+                                              defaultextension = '.json',
+                                              initialfile = 'soco-timings.json',
+                                              filetypes = [('JSON', '*.json')])
+        if not path:
+            return
+
+        try:
+            TIMINGS.export(path)
+        except:
+            logging.error('Could not export timings')
+            logging.error(traceback.format_exc())
+            tkMessageBox.showerror(title = 'Diagnostics...',
+                                   message = 'Could not export timings to:\n%s' % path,
+                                   parent = self)
 
 class SonosList(tk.PanedWindow):
 
@@ -80,19 +717,68 @@ class SonosList(tk.PanedWindow):
                   ipady = 5,
                   sticky = 'news')
 
+        self.startupTimings = {}
+        self.startupBudget = 0.25
+        self.measureStartup = False
+        self.measureStartupTimeout = 30
+        self.__startupSpeaker = None
+        self.__cachedInfoSpeaker = None
+        self._markStartup('imports')
+
         self.__listContent = []
-        self.__queueContent = []
+        self.__queueContent = QueueContent()
+        self.__queueLoading = False
+        self.__queuePage = 0
+        self.__queueVersion = 0
+        self.__queueUpdateId = None
+        self.__queueTotal = None
+        self.__queueSaveAfterId = None
 
         self._controlButtons = {}
         self._infoWidget = {}
 
         self.__lastSelected = None
         self.__lastImage = None
+        self.__albumArtVersion = 0
         self.__currentSpeaker = None
-        self._connection = None
+        self.__speakerTasks = set()
+        self.__playingTrack = None
+        self._controller = SonosController()
+        self._diagnostics = None
+        self.__recentArt = PhotoImageCache()
+        self.__compactAfterId = None
+
+        self.artPrefetchCount = 3
+        self.artPrefetchWorkers = 2
+        self.__artPrefetcher = None
+        self.__artPrefetching = {}
 
         self.empty_info = '-'
+        self.loading_info = 'Loading...'
         self.labelQueue = '%(artist)s - %(title)s'
+        self.queuePageSize = 100
+        self.queueSaveDelay = 2
+        self.shutdownTimeout = 5
+
+        self.scanParallel = True
+        self.scanTimings = {}
+        self.__scanning = False
+
+        self.artCompactDelay = 60
+        self.artCompactInterval = 15 * 60
+
+        self.useEvents = True
+        self._eventListener = None
+        self.__subscribedSpeaker = None
+        self.__subscriptions = {}
+        self.__renewAfterId = None
+
+        self._dispatcher = Dispatcher(self)
+        self.commandWorkers = 8
+        self._commandDispatcher = Dispatcher(self, size = self.commandWorkers)
+        self._volumeSender = VolumeSender(self._commandDispatcher, self)
+        self.__knownVolume = None
+        self.__volumeDragging = False
 
         self._createWidgets()
         self._createMenu()
@@ -110,16 +796,42 @@ class SonosList(tk.PanedWindow):
 
     def destroy(self):
         try:
+            if self.__compactAfterId is not None:
+                self.after_cancel(self.__compactAfterId)
+                self.__compactAfterId = None
+
+            if self._eventListener:
+                self.__unsubscribeEvents(wait = True)
+                self._eventListener.stop()
+                self._eventListener = None
+
+            # Workers may still be writing to the database, they finish
+            # before the controller closes it
+            if self.__artPrefetcher:
+                self.__cancelArtPrefetch()
+                self.__artPrefetcher.shutdown(timeout = self.shutdownTimeout)
+                self.__artPrefetcher = None
+
+            if self._commandDispatcher:
+                self._commandDispatcher.shutdown()
+                self._commandDispatcher = None
+
+            if self._dispatcher:
+                self.__cancelSpeakerLoad()
+                self._dispatcher.shutdown(timeout = self.shutdownTimeout)
+                self._dispatcher = None
+
+            # Only now, a save still running on a worker would overwrite it
+            self.__saveQueue(wait = True)
+
             del self.__listContent[:]
-            del self.__queueContent[:]
+            self.__queueContent.clear()
+            self.__recentArt.clear()
             if self.__currentSpeaker:
                 del self.__currentSpeaker
                 self.__currentSpeaker = None
 
-            if self._connection:
-                logging.info('Closing database connection')
-                self._connection.close()
-                self._connection = None
+            self._controller.close()
         except:
             logging.error('Error while destroying')
             logging.error(traceback.format_exc())
@@ -127,41 +839,126 @@ class SonosList(tk.PanedWindow):
     def __del__(self):
         self.destroy()
 
-    def get_speaker_ips(self):
-        disc = None
-        try:
-            disc = soco.SonosDiscovery()
-            return disc.get_speaker_ips()
-        finally:
-            if disc: del disc
+    def scanSpeakers(self, parallel = None):
+        if self.__scanning:
+            logging.info('Scan already running, skipping')
+            return
+
+        if parallel is None:
+            parallel = self.scanParallel
 
-    def scanSpeakers(self):
-        ips = self.get_speaker_ips()
+        logging.info('Scanning for speakers (parallel: %s)', parallel)
+        self.__scanning = True
+
+        if parallel:
+            self._dispatcher.call(self._controller.discoverIps,
+                                  callback = self.__probeSpeakers,
+                                  errback = self.__scanFailed)
+        else:
+            self._dispatcher.call(self._controller.discoverSpeakers,
+                                  callback = self.__speakersDiscovered,
+                                  errback = self.__scanFailed)
+
+    def __probeSpeakers(self, ips):
+        logging.debug('Probing %d ip(s)', len(ips))
+        self.__addSpeakers([])
+        self.scanTimings = dict((ip, None) for ip in ips)
+
+        if not ips:
+            self.__finishScan(None, [])
+            return
+
+        # Every ip gets its own thread so the scan takes as long as the
+        # slowest speaker (capped by scanTimeout), not the sum of them
+        dispatcher = Dispatcher(self, size = min(len(ips), self._controller.scanWorkers))
+        scan = {
+            'dispatcher': dispatcher,
+            'waiting': set(ips),
+            'speakers': [],
+            'started': time.time(),
+            'afterId': None,
+            }
 
-        speakers = []
         for ip in ips:
-            speaker = WrappedSoCo(ip)
-            if not speaker.speaker_info:
-                logging.warning('Speaker %s does not have any info (probably a bridge), skipping...', ip)
-                continue
+            dispatcher.call(self._controller.probeSpeaker,
+                            (ip,),
+                            callback = lambda result, ip = ip: self.__speakerProbed(scan, ip, result),
+                            errback = lambda errmsg, ip = ip: self.__speakerProbeFailed(scan, ip, errmsg))
+
+        scan['afterId'] = self.after(int(self._controller.scanTimeout * 1000),
+                                     lambda: self.__finishScan(scan, scan['speakers']))
+
+    def __speakerProbed(self, scan, ip, result):
+        speaker, elapsed = result
+        if ip not in scan['waiting']:
+            logging.warning('Speaker %s answered after %.0f ms, past the scan timeout',
+                            ip, elapsed * 1000)
+            return
+
+        scan['waiting'].discard(ip)
+        self.scanTimings[ip] = elapsed
+        logging.info('Probed %s in %.0f ms', ip, elapsed * 1000)
+
+        if not speaker.speaker_info:
+            logging.warning('Speaker %s does not have any info (probably a bridge), skipping...', ip)
+        else:
+            scan['speakers'].append(speaker)
+            self.__insertSpeaker(speaker)
+
+        if not scan['waiting']:
+            self.__finishScan(scan, scan['speakers'])
 
-            speakers.append(speaker)
+    def __speakerProbeFailed(self, scan, ip, errmsg):
+        if ip not in scan['waiting']:
+            return
 
+        scan['waiting'].discard(ip)
+        logging.error('Could not probe speaker %s', ip)
+        logging.error(errmsg)
+
+        if not scan['waiting']:
+            self.__finishScan(scan, scan['speakers'])
+
+    def __finishScan(self, scan, speakers):
+        if scan is not None:
+            if scan['afterId'] is not None:
+                self.after_cancel(scan['afterId'])
+                scan['afterId'] = None
+
+            for ip in scan['waiting']:
+                logging.warning('Speaker %s did not answer within %.1f s', ip, self._controller.scanTimeout)
+            scan['waiting'].clear()
+
+            scan['dispatcher'].shutdown()
+            logging.info('Scan finished in %.0f ms', (time.time() - scan['started']) * 1000)
+
+        self.__scanning = False
         logging.debug('Found %d speaker(s)', len(speakers))
-        if len(speakers) > 1:
-            logging.debug('Sorting speakers based on name')
-            speakers = sorted(speakers,
-                              cmp = lambda a,b: cmp(str(a), str(b)))
+        self._controller.storeSpeakers(speakers)
+
+        for speaker in self._controller.missingSpeakers(speakers, self.__listContent):
+            self.__insertSpeaker(speaker)
 
-        self._storeSpeakers(speakers)
+    def __speakersDiscovered(self, speakers):
+        self.__scanning = False
+        self._controller.storeSpeakers(speakers)
         self.__addSpeakers(speakers)
 
+        for speaker in self._controller.missingSpeakers(speakers, self.__listContent):
+            self.__insertSpeaker(speaker)
+
+    def __scanFailed(self, errmsg):
+        self.__scanning = False
+        logging.error(errmsg)
+        tkMessageBox.showerror(title = 'Scan...',
+                               message = 'Could not scan for speakers')
+
     def _cleanExit(self):
         try:
             geometry = self.__parent.geometry()
             if geometry:
                 logging.debug('Storing geometry: "%s"', geometry)
-                self.__setConfig('window_geometry', geometry)
+                self._controller.setConfig('window_geometry', geometry)
 
             listOfPanes = self.panes()
             sashes = []
@@ -173,7 +970,9 @@ class SonosList(tk.PanedWindow):
 
             finalSashValue = ','.join(sashes)
             logging.debug('Storing sashes: "%s"', finalSashValue)
-            self.__setConfig('sash_coordinates', finalSashValue)
+            self._controller.setConfig('sash_coordinates', finalSashValue)
+
+            self._controller.flush()
                 
         except:
             logging.error('Error making clean exit')
@@ -197,6 +996,19 @@ class SonosList(tk.PanedWindow):
         for speaker in speakers:
             self.__listContent.append(speaker)
             self._listbox.insert(tk.END, speaker)
+
+    def __insertSpeaker(self, speaker):
+        # Keeps the list sorted by name while speakers trickle in
+        names = [str(item) for item in self.__listContent]
+        index = bisect.bisect_right(names, str(speaker))
+
+        self.__listContent.insert(index, speaker)
+        self._listbox.insert(index, speaker)
+
+        current = self.__currentSpeaker
+        if current is not None and\
+           current.speaker_info.get('uid') == speaker.speaker_info.get('uid'):
+            self._listbox.selection_set(index)
         
     def _createWidgets(self):
         logging.debug('Creating widgets')
@@ -226,25 +1038,33 @@ class SonosList(tk.PanedWindow):
                            sticky = 'news')
 
 
+        # Create queue search, filters as you type
+        self._queueSearch = tk.StringVar()
+        self._queueSearch.trace('w', lambda *args: self.__filterQueue())
+
+        self._queueSearchEntry = tk.Entry(self._right,
+                                          textvariable = self._queueSearch)
+        self._queueSearchEntry.bind('<FocusIn>', lambda evt: self.__queueContent.buildSearchIndex())
+        self._queueSearchEntry.bind('<Escape>', lambda evt: self._queueSearch.set(''))
+
+        self._queueSearchEntry.grid(row = 0,
+                                    column = 0,
+                                    padx = 5,
+                                    pady = (5, 0),
+                                    sticky = 'we')
+
         # Create queue list
-        scrollbar = tk.Scrollbar(self._right)
-        self._queuebox = tk.Listbox(self._right,
-                                    selectmode = tk.EXTENDED)
+        self._queueview = QueueView(self._right,
+                                    lambda item: self.labelQueue % item)
 
-        scrollbar.config(command = self._queuebox.yview)
-        self._queuebox.config(yscrollcommand = scrollbar.set)
-        self._queuebox.bind('<Double-Button-1>', self._playSelectedQueueItem)
-        
-        scrollbar.grid(row = 0,
-                       column = 1,
-                       pady = 5,
-                       sticky = 'ns')
+        self._queueview.onActivate = self._playSelectedQueueItem
+        self._queueview.onNeedMore = self.__loadMoreQueue
         
-        self._queuebox.grid(row = 0,
-                            column = 0,
-                            padx = 5,
-                            pady = 5,
-                            sticky = 'news')
+        self._queueview.grid(row = 1,
+                             column = 0,
+                             padx = 5,
+                             pady = 5,
+                             sticky = 'news')
 
         self._createButtons()
                           
@@ -254,7 +1074,7 @@ class SonosList(tk.PanedWindow):
         self._center.rowconfigure(0, weight = 1)
         self._center.columnconfigure(0, weight = 1)
 
-        self._right.rowconfigure(0, weight = 1)
+        self._right.rowconfigure(1, weight = 1)
         self._right.columnconfigure(0, weight = 1)
 
         self._info = tk.Frame(self._center)
@@ -341,7 +1161,8 @@ class SonosList(tk.PanedWindow):
                                               from_ = 0,
                                               to = 100,
                                               tickinterval = 10,
-                                              orient = tk.HORIZONTAL)
+                                              orient = tk.HORIZONTAL,
+                                              command = self._volumeChanged)
         
         self._infoWidget['volume'].grid(row = infoIndex,
                                         column = 1,
@@ -349,7 +1170,8 @@ class SonosList(tk.PanedWindow):
                                         pady = 5,
                                         sticky = 'we')
 
-        self._infoWidget['volume'].bind('<ButtonRelease-1>', self._volumeChanged)
+        self._infoWidget['volume'].bind('<ButtonPress-1>', lambda evt: self.__setVolumeDragging(True))
+        self._infoWidget['volume'].bind('<ButtonRelease-1>', lambda evt: self.__setVolumeDragging(False))
         infoIndex += 1
 
         ###################################
@@ -383,38 +1205,76 @@ class SonosList(tk.PanedWindow):
 
         return speaker
 
-    def __getSelectedQueueItem(self):
-        widget = self._queuebox
+    def __getSelectedSpeakers(self):
+        # Commands go to every selected speaker, the info shown is the
+        # first one's
+        speakers = [self.__listContent[int(index)] for index in self._listbox.curselection()
+                    if int(index) < len(self.__listContent)]
+
+        # A rescan selects the newly probed object for the current speaker,
+        # it is the same speaker when the uid matches
+        current = self.__currentSpeaker
+        if current is not None:
+            uid = current.speaker_info.get('uid')
+            if not any(speaker is current or (uid and speaker.speaker_info.get('uid') == uid)
+                       for speaker in speakers):
+                speakers.insert(0, current)
 
-        selection = widget.curselection()
-        if not selection:
-            return None, None
+        return speakers
 
-        index = int(selection[0])
+    def __getSelectedQueueItem(self):
+        index = self._queueview.selectedIndex()
+        if index is None:
+            return None, None
 
         assert len(self.__queueContent) > index
         track = self.__queueContent[index]
 
         return track, index
         
-    def _volumeChanged(self, evt):
+    def _volumeChanged(self, value):
+        # Called for every step while dragging, but also when we set the
+        # slider ourselves, which must not be sent back to the speaker
+        volume = int(float(value))
+        if volume == self.__knownVolume:
+            return
+
         if not self.__currentSpeaker:
             logging.warning('No speaker selected')
             return
         
-        speaker = self.__currentSpeaker
-        volume = self._infoWidget['volume'].get()
+        self.__knownVolume = volume
+        for speaker in self.__getSelectedSpeakers():
+            self._volumeSender.send(speaker, volume)
+
+    def __setVolumeDragging(self, dragging):
+        self.__volumeDragging = dragging
+
+    def __showVolume(self, speaker, volume):
+        # Values coming from the speaker while the user is still moving
+        # the slider are already out of date
+        if self.__volumeDragging or\
+           (speaker is not None and self._volumeSender.busy(speaker)):
+            logging.debug('Volume change in progress, not showing: %s', volume)
+            return
 
-        logging.debug('Changing volume to: %d', volume)
-        speaker.volume(volume)
+        self.__knownVolume = volume
+        self._infoWidget['volume'].set(volume)
 
     def __clear(self, typeName):
         if typeName == 'queue':
             logging.debug('Deleting old items')
-            self._queuebox.delete(0, tk.END)
-            del self.__queueContent[:]
-            self.__queueContent = []
+            self.__queueContent.clear()
+            self.__queueContent = QueueContent()
+            self.__queueLoading = False
+            self.__queuePage += 1
+            self.__queueVersion += 1
+            self.__queueUpdateId = None
+            self.__queueTotal = None
+            self._queueview.setItems(self.__queueContent)
+            self.__filterQueue()
         elif typeName == 'album_art':
+            self.__albumArtVersion += 1
             self._infoWidget[typeName].config(image = None)
             if self.__lastImage:
                 del self.__lastImage
@@ -428,7 +1288,7 @@ class SonosList(tk.PanedWindow):
         if not selection:
             self.showSpeakerInfo(None)            
             self._updateButtons()
-            self.__setConfig('last_selected', None)
+            self._controller.setConfig('last_selected', None)
             return
 
         index = int(selection[0])
@@ -446,24 +1306,36 @@ class SonosList(tk.PanedWindow):
         logging.debug('Zoneplayer: "%s"', speaker)
 
         logging.debug('Storing last_selected: %s' % speaker.speaker_info['uid'])
-        self.__setConfig('last_selected', speaker.speaker_info['uid'])
+        self._controller.setConfig('last_selected', speaker.speaker_info['uid'])
         
 
     def showSpeakerInfo(self, speaker, refresh_queue = True):
-        if not isinstance(speaker, soco.SoCo) and\
+        if not isinstance(speaker, WrappedSoCo) and\
            speaker is not None:
             raise TypeError('Unsupported type: %s', type(speaker))
 
+        sameSpeaker = speaker is not None and speaker is self.__currentSpeaker
+
+        # The queue shown still belongs to the outgoing speaker, it has
+        # to be saved under that speaker before we switch
+        if not sameSpeaker:
+            self.__saveQueue()
         self.__currentSpeaker = speaker
+
+        if not sameSpeaker:
+            self.__cancelSpeakerLoad()
+            self.__cancelArtPrefetch()
+            self.__subscribeEvents(speaker)
         
         newState = tk.ACTIVE if speaker is not None else tk.DISABLED
         self._infoWidget['volume'].config(state = newState)
         
         if speaker is None:
-            self.__clearQueue()
+            self.__playingTrack = None
+            self.__clear('queue')
             for info in self._infoWidget.keys():
                 if info == 'volume':
-                    self._infoWidget[info].set(0)
+                    self.__showVolume(None, 0)
                     continue
                 elif info == 'album_art':
                     self.__clear(info)
@@ -475,69 +1347,445 @@ class SonosList(tk.PanedWindow):
         #######################
         # Load speaker info
         #######################
-        playingTrack = None
-        try:
-            logging.info('Receive speaker info from: "%s"' % speaker)
-            track = speaker.get_current_track_info()
-            playingTrack = track['uri']
+        if speaker is not self.__cachedInfoSpeaker:
+            for info in ('title', 'artist', 'album'):
+                self._infoWidget[info].config(text = self.loading_info)
+        self.__cachedInfoSpeaker = None
 
-            track['volume'] = speaker.volume()
-            
-            self.__clear('album_art')
-            for info, value in track.items():
-                if info == 'album_art':
-                    self.__setAlbumArt(value, track_uri = playingTrack)
-                    continue
-                elif info == 'volume':
-                    self._infoWidget[info].set(value)
-                    continue
-                elif info not in self._infoWidget:
-                    logging.debug('Skipping info "%s": "%s"', info, value)
-                    continue
-                
-                label = self._infoWidget[info]
-                label.config(text = value if value else self.empty_info)
-        except:
-            errmsg = traceback.format_exc()
-            logging.error(errmsg)
-            tkMessageBox.showerror(title = 'Speaker info...',
-                                   message = 'Could not receive speaker information')
+        logging.info('Receive speaker info from: "%s"' % speaker)
+        self.__speakerCall(self._controller.getTrackInfo,
+                           (speaker,),
+                           callback = lambda track: self.__showTrackInfo(speaker, track),
+                           errback = lambda errmsg: self.__speakerInfoFailed(speaker, errmsg))
 
         #######################
         # Load queue
         #######################
+        if refresh_queue and sameSpeaker and self.__queueContent:
+            self.refreshQueue()
+        elif refresh_queue:
+            logging.debug('Deleting old items')
+            self.__clear('queue')
+            self._queueview.showMessage(self.loading_info)
+            self.__loadCachedQueue(speaker)
+
+    def __speakerCall(self, func, args, callback, errback):
+        # Everything loaded for the selected speaker goes through here and
+        # is cancelled at once when another one is selected: a call still
+        # waiting for a worker is never made, a result is never delivered
+        tasks = self.__speakerTasks
+
+        def finished(handler):
+            def deliver(value):
+                tasks.discard(task)
+                handler(value)
+            return deliver
+
+        task = self._dispatcher.call(func,
+                                     args,
+                                     callback = finished(callback),
+                                     errback = finished(errback))
+        tasks.add(task)
+        return task
+
+    def __cancelSpeakerLoad(self):
+        if self.__speakerTasks:
+            logging.debug('Cancelling %d call(s) for the previous speaker', len(self.__speakerTasks))
+
+        for task in self.__speakerTasks:
+            task.cancel()
+        self.__speakerTasks = set()
+
+    def __showTrackInfo(self, speaker, track):
+        self.__playingTrack = track.get('uri', self.__playingTrack)
+        self._controller.storeSpeakerState(speaker, track)
+        self._markStartup('live_track')
+
+        self.__clear('album_art')
+        for info, value in track.items():
+            if info == 'album_art':
+                self.__setAlbumArt(value,
+                                   track_uri = self.__playingTrack,
+                                   album_key = self._controller.getAlbumKey(track))
+                continue
+            elif info == 'volume':
+                self.__showVolume(speaker, value)
+                continue
+            elif info not in self._infoWidget:
+                logging.debug('Skipping info "%s": "%s"', info, value)
+                continue
+            
+            label = self._infoWidget[info]
+            label.config(text = value if value else self.empty_info)
+
+        self.__selectPlayingTrack()
+        self.__prefetchArt()
+
+    def __speakerInfoFailed(self, speaker, errmsg):
+        logging.error(errmsg)
+
+        for info in ('title', 'artist', 'album'):
+            self._infoWidget[info].config(text = self.empty_info)
+
+        tkMessageBox.showerror(title = 'Speaker info...',
+                               message = 'Could not receive speaker information')
+
+    def __loadQueuePage(self, speaker):
+        # The queue is fetched one page at a time, the next page is only
+        # requested once the view scrolls close to the end of what we have
+        if self.__queueLoading:
+            return
+
+        self.__queueLoading = True
+        self.__queuePage += 1
+        page = self.__queuePage
+        start = len(self.__queueContent)
+
+        logging.debug('Requesting queue items %d-%d', start, start + self.queuePageSize)
+        self.__speakerCall(self._controller.browseQueue,
+                           (speaker, start, self.queuePageSize),
+                           callback = lambda result: self.__showQueuePage(speaker, page, start, result),
+                           errback = lambda errmsg: self.__queueFailed(speaker, errmsg))
+
+    def __loadMoreQueue(self):
+        if self.__currentSpeaker is not None:
+            self.__loadQueuePage(self.__currentSpeaker)
+
+    def __showQueuePage(self, speaker, page, start, result):
+        if page != self.__queuePage:
+            logging.debug('Dropping queue page for "%s", no longer wanted', speaker)
+            return
+
+        self.__queueLoading = False
+        if start != len(self.__queueContent):
+            # A refresh changed the queue length meanwhile, the view asks
+            # for the page that does follow when it needs one
+            logging.debug('Dropping queue page for "%s", queue changed', speaker)
+            self._queueview.itemsChanged()
+            return
+
+        queue, total, updateId = result
+        self._markStartup('live_queue')
+
+        logging.debug('Adding items (%d) to queue', len(queue))
+        self.__queueContent.extend(queue)
+        self.__queueVersion += 1
+        self._queueview.itemsChanged(complete = not queue or len(self.__queueContent) >= total)
+        self.__filterQueue(scrollToTop = False)
+
+        # A page of a newer queue than the pages before it, what we have
+        # is a mix of both until it has been refreshed
+        if start and updateId != self.__queueUpdateId:
+            logging.info('Queue changed while loading, refreshing')
+            self.__queueUpdateId = None
+            self.refreshQueue()
+        else:
+            self.__queueUpdateId = updateId
+            self.__queueTotal = total
+            self.__scheduleQueueSave()
+
+        self.__selectPlayingTrack()
+        self.__prefetchArt()
+
+    def __loadCachedQueue(self, speaker):
+        # The queue stored for speaker is read and decoded on a worker,
+        # no page is requested from the speaker in the meantime
+        version = self.__queueVersion
+        self.__queueLoading = True
+        self.__speakerCall(self._controller.loadQueueCache,
+                           (speaker,),
+                           callback = lambda cached: self.__cachedQueueLoaded(speaker, version, cached),
+                           errback = lambda errmsg: self.__cachedQueueLoaded(speaker, version, None, errmsg))
+
+    def __cachedQueueLoaded(self, speaker, version, cached, errmsg = None):
+        # Shows the queue stored for speaker and validates it against the
+        # speaker, without one the queue is paged in from the speaker
+        if version != self.__queueVersion:
+            logging.debug('Queue changed while reading the cached one, dropping it')
+            return
+
+        self.__queueLoading = False
+        if errmsg is not None:
+            logging.error('Could not load cached queue')
+            logging.error(errmsg)
+
+        if cached is None:
+            logging.info('Gettting queue from speaker')
+            self.__loadQueuePage(speaker)
+            return
+
+        logging.info('Showing %d cached queue item(s) (update id: %s)', len(cached['items']), cached['update_id'])
+        self.__queueContent = cached['items']
+        self.__queueVersion += 1
+        self.__queueUpdateId = cached['update_id']
+        self.__queueTotal = cached['total']
+        self._queueview.setItems(self.__queueContent,
+                                 complete = len(self.__queueContent) >= cached['total'])
+        self.__filterQueue()
+
+        self.__selectPlayingTrack()
+        self.__validateQueue(speaker)
+
+    def __validateQueue(self, speaker):
+        version = self.__queueVersion
+        self.__speakerCall(self._controller.getQueueVersion,
+                           (speaker,),
+                           callback = lambda result: self.__queueValidated(speaker, version, result),
+                           errback = lambda errmsg: self.__queueFailed(speaker, errmsg))
+
+    def __queueValidated(self, speaker, version, result):
+        if version != self.__queueVersion:
+            logging.debug('Queue changed while validating, dropping result')
+            return
+
+        updateId, total = result
+        if updateId is not None and\
+           updateId == self.__queueUpdateId and\
+           total == self.__queueTotal:
+            logging.info('Cached queue is up to date (update id: %s)', updateId)
+            self._markStartup('live_queue')
+            self.__prefetchArt()
+            return
+
+        logging.info('Cached queue is out of date (update id: %s, speaker: %s)', self.__queueUpdateId, updateId)
+        self.__queueUpdateId = None
+        self.refreshQueue()
+
+    def __scheduleQueueSave(self):
+        # Loading page after page only writes the queue once it settled
+        if self.__queueSaveAfterId is None:
+            self.__queueSaveAfterId = self.after(self.queueSaveDelay * 1000, self.__saveQueue)
+
+    def __saveQueue(self, wait = False):
+        # Encoding a big queue takes a while, it is done on a worker
+        # unless we are about to close
+        if self.__queueSaveAfterId is None:
+            return
+
+        self.after_cancel(self.__queueSaveAfterId)
+        self.__queueSaveAfterId = None
+
+        speaker = self.__currentSpeaker
+        if speaker is None or self.__queueUpdateId is None:
+            return
+
+        args = (speaker, self.__queueUpdateId, self.__queueTotal, list(self.__queueContent))
+        if not wait:
+            self._dispatcher.call(self._controller.storeQueueCache,
+                                  args,
+                                  errback = lambda errmsg: logging.error('Could not store queue: %s', errmsg))
+            return
+
         try:
-            select = None
-            if refresh_queue:
-                logging.info('Gettting queue from speaker')
-                queue = speaker.get_queue()
-
-                logging.debug('Deleting old items')
-                self.__clear('queue')
-
-                logging.debug('Inserting items (%d) to listbox', len(queue))
-                for index, item in enumerate(queue):
-                    string = self.labelQueue % item
-                    self.__queueContent.append(item)
-                    self._queuebox.insert(tk.END, string)
-
-            if playingTrack is not None:
-                for index, item in enumerate(self.__queueContent):
-                    if item['uri'] == playingTrack:
-                        self._queuebox.selection_clear(0, tk.END)
-                        self._queuebox.selection_anchor(index)
-                        self._queuebox.selection_set(index)
-                        break
-                
+            self._controller.storeQueueCache(*args)
         except:
-            errmsg = traceback.format_exc()
-            logging.error(errmsg)
-            tkMessageBox.showerror(title = 'Queue...',
-                                   message = 'Could not receive speaker queue')
-                
+            logging.error('Could not store queue')
+            logging.error(traceback.format_exc())
 
-    def __setAlbumArt(self, url, track_uri = None):
-        if ImageTk is None:
+    def refreshQueue(self):
+        # Fetches the loaded part of the queue again and only applies
+        # what changed, selection and scroll position stay where they were
+        speaker = self.__currentSpeaker
+        if speaker is None:
+            return
+
+        if not self.__queueContent:
+            self.showSpeakerInfo(speaker)
+            return
+
+        version = self.__queueVersion
+        oldUris = self.__queueContent.uris()
+
+        logging.info('Refreshing queue from speaker')
+        self.__speakerCall(self._controller.fetchQueueChanges,
+                           (speaker, oldUris, self.queuePageSize),
+                           callback = lambda result: self.__queueRefreshed(speaker, version, result),
+                           errback = lambda errmsg: self.__queueFailed(speaker, errmsg))
+
+    def __queueRefreshed(self, speaker, version, result):
+        if version != self.__queueVersion:
+            logging.debug('Queue changed while refreshing, dropping refresh')
+            return
+
+        queue, complete, edits, mapIndex, updateId, total = result
+        logging.debug('Applying %d queue edit(s)', len(edits))
+
+        self.__queueContent.applyDiff(queue, edits)
+        self.__queueVersion += 1
+        self.__queueUpdateId = updateId
+        self.__queueTotal = total
+        self.__scheduleQueueSave()
+
+        self._queueview.complete = complete
+        self._queueview.remap(mapIndex)
+        self.__filterQueue(scrollToTop = False)
+        self.__selectPlayingTrack()
+        self.__prefetchArt()
+
+    def __queueFailed(self, speaker, errmsg):
+        logging.error(errmsg)
+
+        self.__clear('queue')
+        tkMessageBox.showerror(title = 'Queue...',
+                               message = 'Could not receive speaker queue')
+
+    def __filterQueue(self, scrollToTop = True):
+        # Runs whenever the search text or the queue changes
+        text = self._queueSearch.get()
+        positions = self.__queueContent.search(text) if text else None
+        if positions is None and self._queueview.filter is None:
+            return
+
+        self._queueview.setFilter(positions, scrollToTop)
+
+    def __selectPlayingTrack(self):
+        if self.__playingTrack is None:
+            return
+
+        index = self.__queueContent.indexOf(self.__playingTrack)
+        if index is not None:
+            self._queueview.select(index, see = False)
+
+    def __subscribeEvents(self, speaker):
+        self.__unsubscribeEvents()
+        if speaker is None or not self.useEvents:
+            return
+
+        if self._eventListener is None:
+            self._eventListener = EventListener(
+                lambda sid, service, seq, changes: self._dispatcher.post(self.__eventReceived,
+                                                                         (sid, service, seq, changes)))
+            try:
+                self._eventListener.start()
+            except:
+                logging.error('Could not start event listener, falling back to polling')
+                logging.error(traceback.format_exc())
+                self._eventListener = None
+                self.useEvents = False
+                return
+
+            self._dispatcher.startIdlePolling()
+
+        self.__subscribedSpeaker = speaker
+        self._dispatcher.call(self.__subscribeSpeaker,
+                              (speaker,),
+                              callback = lambda subscriptions: self.__eventsSubscribed(speaker, subscriptions))
+
+    def __subscribeSpeaker(self, speaker):
+        # Runs on a worker thread, must not touch any widget. Not made at
+        # all if another speaker was selected while this one waited
+        subscriptions = {}
+        if speaker is not self.__subscribedSpeaker:
+            return subscriptions
+
+        for service in ('transport', 'rendering', 'queue', 'content'):
+            if service == 'content' and 'queue' in subscriptions:
+                continue
+
+            try:
+                subscriptions[service] = self._eventListener.subscribe(speaker.speaker_ip, service)
+            except:
+                logging.warning('Could not subscribe to %s events of "%s"', service, speaker)
+                logging.debug(traceback.format_exc())
+
+        return subscriptions
+
+    def __eventsSubscribed(self, speaker, subscriptions):
+        sids = dict((service, sid) for service, (sid, timeout) in subscriptions.items())
+        if speaker is not self.__subscribedSpeaker:
+            if sids:
+                self._dispatcher.call(self.__unsubscribeSpeaker, (speaker.speaker_ip, sids))
+            return
+
+        logging.info('Subscribed to events of "%s": %s', speaker, ', '.join(sorted(sids)))
+        self.__subscriptions = sids
+
+        if subscriptions:
+            timeout = min(timeout for sid, timeout in subscriptions.values())
+            self.__renewAfterId = self.after(max(30, timeout - 60) * 1000, self.__renewEvents)
+
+    def __renewEvents(self):
+        self.__renewAfterId = None
+        speaker = self.__subscribedSpeaker
+        sids = dict(self.__subscriptions)
+
+        def renew():
+            return min([self._eventListener.renew(speaker.speaker_ip, service, sid)
+                        for service, sid in sids.items()])
+
+        def renewed(timeout):
+            if speaker is self.__subscribedSpeaker:
+                self.__renewAfterId = self.after(max(30, timeout - 60) * 1000, self.__renewEvents)
+
+        def renewFailed(errmsg):
+            logging.warning('Could not renew event subscriptions, subscribing again')
+            logging.debug(errmsg)
+            if speaker is self.__subscribedSpeaker:
+                self.__subscribeEvents(speaker)
+
+        self._dispatcher.call(renew,
+                              callback = renewed,
+                              errback = renewFailed)
+
+    def __unsubscribeEvents(self, wait = False):
+        if self.__renewAfterId is not None:
+            self.after_cancel(self.__renewAfterId)
+            self.__renewAfterId = None
+
+        speaker = self.__subscribedSpeaker
+        sids = self.__subscriptions
+
+        self.__subscribedSpeaker = None
+        self.__subscriptions = {}
+
+        if speaker is None or not sids:
+            return
+
+        if wait:
+            self.__unsubscribeSpeaker(speaker.speaker_ip, sids)
+        else:
+            self._dispatcher.call(self.__unsubscribeSpeaker, (speaker.speaker_ip, sids))
+
+    def __unsubscribeSpeaker(self, speaker_ip, sids):
+        for service, sid in sids.items():
+            try:
+                self._eventListener.unsubscribe(speaker_ip, service, sid)
+            except:
+                logging.debug('Could not unsubscribe from %s events of %s', service, speaker_ip)
+                logging.debug(traceback.format_exc())
+
+    def __eventsActive(self, speaker):
+        return speaker is self.__subscribedSpeaker and\
+               'transport' in self.__subscriptions and\
+               'rendering' in self.__subscriptions
+
+    def __eventReceived(self, sid, service, seq, changes):
+        speaker = self.__currentSpeaker
+        if speaker is None or\
+           speaker is not self.__subscribedSpeaker or\
+           self.__subscriptions.get(service) != sid:
+            logging.debug('Dropping %s event, not for the current speaker', service)
+            return
+
+        logging.debug('Received %s event (seq: %s): %s', service, seq, changes.keys())
+        if 'volume' in changes:
+            self.__showVolume(speaker, changes['volume'])
+
+        if 'title' in changes.get('track', {}):
+            self.__showTrackInfo(speaker, changes['track'])
+
+        # The first notification only tells us what we just loaded
+        if changes.get('queue') and seq != '0':
+            self.refreshQueue()
+
+    def __getThumbSize(self):
+        widgetConfig = self._infoWidget['album_art'].config()
+        return (int(widgetConfig['width'][4]),
+                int(widgetConfig['height'][4]))
+
+    @timed('ui.setAlbumArt')
+    def __setAlbumArt(self, url, track_uri = None, album_key = None, download = True):
+        if not loadImageTk():
             logging.warning('python-imaging-tk lib missing, skipping album art')
             return
 
@@ -545,73 +1793,314 @@ class SonosList(tk.PanedWindow):
             logging.warning('url is empty, returnning')
             return
 
-        connection = None
-        newImage = None
+        thumbSize = self.__getThumbSize()
+        sources = (url, album_key)
+
+        # Shown recently, nothing to look up or decode
+        if track_uri:
+            photo = self.__recentArt.getAlias((track_uri, thumbSize))
+            if photo is not None:
+                logging.debug('Album art for uri "%s" still in memory', track_uri)
+                self.__setPhoto(photo)
+                return
         
-        # Receive Album art, resize it and show it
+        # Check for cached albumart, a cached thumbnail is shown as is
+        # and an original (if we kept one) only needs to be resized
         try:
+            art_hash, thumbnail, raw_data = self._controller.findCachedArt(track_uri,
+                                                                           sources,
+                                                                           thumbSize,
+                                                                           original = True)
+
+            photo = self.__recentArt.get((art_hash, thumbSize)) if art_hash else None
+            if photo is not None:
+                logging.debug('Album art %s still in memory', art_hash)
+                self.__recentArt.addAlias((track_uri, thumbSize), (art_hash, thumbSize))
+                self.__setPhoto(photo)
+                return
 
-            raw_data = None
-            
-            # Check for cached albumart
-            if track_uri:
-                try:
-                    __sql = '''
-                        SELECT image FROM images AS i
-                        WHERE
-                            i.uri = ?
-                        LIMIT 1
-                    '''
-                    with clib.closing(self._connection.execute(__sql, (track_uri,))) as cur:
-                        row = cur.fetchone()
-                        if row:
-                            logging.debug('Found album art for uri: "%s"', track_uri)
-                            raw_data = str(row['image'])
-                except:
-                    logging.warning('Could not load album art from database')
-                    logging.error(traceback.format_exc())
-
-            if raw_data is None:
-                logging.info('Could not find cached album art, loading from URL')
-                connection = urllib.urlopen(url)
-                raw_data = connection.read()
-
-                try:
-                    __sql = '''
-                        INSERT OR REPLACE INTO images (
-                            uri,
-                            image
-                        ) VALUES (?, ?)
-                    '''
-                    logging.info('Storing album art for uri: "%s"', track_uri)
-                    self._connection.execute(__sql, (track_uri,
-                                                     buffer(raw_data))).close()
-
-                    self._connection.commit()
-                except:
-                    logging.error('Could not store album art')
-                    logging.error(traceback.format_exc())
-
-            image = Image.open(sio.StringIO(raw_data))
-            widgetConfig = self._infoWidget['album_art'].config()
-            thumbSize = (int(widgetConfig['width'][4]),
-                         int(widgetConfig['height'][4]))
-
-            logging.debug('Resizing album art to: %s', thumbSize)
-            image.thumbnail(thumbSize,
-                            Image.ANTIALIAS)
-            newImage = ImageTk.PhotoImage(image = image)
-            self._infoWidget['album_art'].config(image = newImage)
+            if thumbnail is not None:
+                logging.debug('Found album art thumbnail for uri: "%s"', track_uri)
+                self.__showAlbumArt(url,
+                                    openImage(thumbnail),
+                                    (art_hash, thumbSize),
+                                    track_uri)
+                return
+
+            if raw_data is not None:
+                logging.debug('Found album art for uri: "%s"', track_uri)
+                self.__decodeAlbumArt(self._controller.decodeAlbumArt,
+                                      (raw_data, thumbSize),
+                                      url, track_uri, album_key,
+                                      storeOriginal = False)
+                return
+        except:
+            logging.warning('Could not load album art from database')
+            logging.error(traceback.format_exc())
+
+        if not download:
+            logging.debug('Album art for uri "%s" not cached, not loading', track_uri)
+            return
+
+        logging.info('Could not find cached album art, loading from URL')
+        self._controller.artCache.recordMiss()
+        self.__decodeAlbumArt(self._controller.fetchAlbumArt,
+                              (url, thumbSize),
+                              url, track_uri, album_key)
+
+    def __decodeAlbumArt(self, func, args, url, track_uri, album_key, storeOriginal = True):
+        # Download, decode and resize run on a worker, the result is
+        # only shown if the track did not change in the meantime
+        version = self.__albumArtVersion
+        thumbSize = self.__getThumbSize()
+        self.__speakerCall(func,
+                           args,
+                           callback = lambda result: self.__albumArtDecoded(version, url, track_uri, album_key, thumbSize, storeOriginal, result),
+                           errback = lambda errmsg: self.__albumArtFailed(url, errmsg))
+
+    def __albumArtDecoded(self, version, url, track_uri, album_key, thumbSize, storeOriginal, result):
+        raw_data, art_hash, image, thumbnail = result
+
+        # Stored even when it arrived too late, the work is done already
+        try:
+            self._controller.storeAlbumArt(result,
+                                           thumbSize,
+                                           [track_uri] if track_uri else [],
+                                           (url, album_key),
+                                           storeOriginal)
+        except:
+            logging.error('Could not store album art')
+            logging.error(traceback.format_exc())
+
+        if version != self.__albumArtVersion:
+            logging.debug('Album art for "%s" arrived too late, not showing', track_uri)
+            return
+
+        self.__showAlbumArt(url,
+                            image,
+                            (art_hash, thumbSize),
+                            track_uri)
+
+    def __albumArtFailed(self, url, errmsg):
+        logging.error('Could not set album art, skipping...')
+        logging.error(url)
+        logging.error(errmsg)
+
+    def __showAlbumArt(self, url, image, key = None, track_uri = None):
+        try:
+            newImage = makePhotoImage(image)
         except:
             logging.error('Could not set album art, skipping...')
             logging.error(url)
             logging.error(traceback.format_exc())
+            return
+
+        if key is not None:
+            self.__recentArt.put(key,
+                                 newImage,
+                                 aliases = ((track_uri, key[1]),) if track_uri else ())
+
+        self.__setPhoto(newImage)
+
+    def __setPhoto(self, newImage):
+        try:
+            self._infoWidget['album_art'].config(image = newImage)
+        except:
+            logging.error('Could not set album art, skipping...')
+            logging.error(traceback.format_exc())
+            newImage = None
         finally:
-            if connection: connection.close()
-            
             if self.__lastImage: del self.__lastImage
             self.__lastImage = newImage
 
+    def __prefetchArt(self):
+        # Warms the art cache for the tracks after the one playing, so
+        # skipping ahead finds the cover decoded in memory already
+        speaker = self.__currentSpeaker
+        if speaker is None or\
+           self.__playingTrack is None or\
+           not self.artPrefetchCount or\
+           not loadImageTk():
+            return
+
+        playing = self.__queueContent.indexOf(self.__playingTrack)
+        if playing is None:
+            return
+
+        thumbSize = self.__getThumbSize()
+        for item in self.__queueContent[playing + 1:playing + 1 + self.artPrefetchCount]:
+            url = item.get('album_art')
+            track_uri = item.get('uri')
+            if not url or not track_uri:
+                continue
+
+            if self.__recentArt.getAlias((track_uri, thumbSize)) is not None:
+                continue
+
+            album_key = self._controller.getAlbumKey(item)
+            try:
+                if self.__prefetchCachedArt(url, track_uri, album_key, thumbSize):
+                    continue
+            except:
+                logging.warning('Could not prefetch album art from database')
+                logging.error(traceback.format_exc())
+                continue
+
+            # Tracks of the same album wait for the one download
+            source = album_key or url
+            if source in self.__artPrefetching:
+                self.__artPrefetching[source]['tracks'].add(track_uri)
+                continue
+
+            if self.__artPrefetcher is None:
+                self.__artPrefetcher = Dispatcher(self, size = self.artPrefetchWorkers)
+
+            logging.debug('Prefetching album art for uri "%s"', track_uri)
+            self._controller.artCache.recordMiss()
+            task = self.__artPrefetcher.call(self._controller.fetchAlbumArt,
+                                             (url, thumbSize),
+                                             callback = lambda result, source = source: self.__artPrefetched(speaker, source, result),
+                                             errback = lambda errmsg, source = source: self.__artPrefetchFailed(source, errmsg))
+            self.__artPrefetching[source] = {
+                'task': task,
+                'url': url,
+                'album_key': album_key,
+                'size': thumbSize,
+                'tracks': set([track_uri]),
+                }
+
+    def __prefetchCachedArt(self, url, track_uri, album_key, thumbSize):
+        art_hash, thumbnail, raw_data = self._controller.findCachedArt(track_uri,
+                                                                       (url, album_key),
+                                                                       thumbSize)
+        if art_hash is None:
+            return False
+
+        key = (art_hash, thumbSize)
+        if self.__recentArt.get(key) is not None:
+            self.__recentArt.addAlias((track_uri, thumbSize), key)
+            return True
+
+        if thumbnail is None:
+            return False
+
+        self.__recentArt.put(key,
+                             makePhotoImage(openImage(thumbnail)),
+                             aliases = ((track_uri, thumbSize),))
+        return True
+
+    def __artPrefetched(self, speaker, source, result):
+        pending = self.__artPrefetching.pop(source, None)
+        if pending is None:
+            return
+
+        raw_data, art_hash, image, thumbnail = result
+        thumbSize = pending['size']
+
+        self._controller.storeAlbumArt(result,
+                                       thumbSize,
+                                       pending['tracks'],
+                                       (pending['url'], pending['album_key']))
+
+        if speaker is not self.__currentSpeaker:
+            return
+
+        key = (art_hash, thumbSize)
+        aliases = [(track_uri, thumbSize) for track_uri in pending['tracks']]
+        if self.__recentArt.get(key) is not None:
+            for alias in aliases:
+                self.__recentArt.addAlias(alias, key)
+            return
+
+        try:
+            photo = makePhotoImage(image)
+        except:
+            logging.error('Could not prefetch album art')
+            logging.error(traceback.format_exc())
+            return
+
+        self.__recentArt.put(key, photo, aliases = aliases)
+        logging.debug('Prefetched album art %s for %d track(s)', art_hash, len(pending['tracks']))
+
+    def __artPrefetchFailed(self, source, errmsg):
+        pending = self.__artPrefetching.pop(source, None)
+        if pending is None:
+            return
+
+        logging.warning('Could not prefetch album art: %s', pending['url'])
+        logging.debug(errmsg)
+
+    def __cancelArtPrefetch(self):
+        for pending in self.__artPrefetching.values():
+            pending['task'].cancel()
+        self.__artPrefetching.clear()
+
+    def __compactArtCache(self):
+        self.__compactAfterId = None
+
+        def compacted(evicted):
+            logging.info('Album art cache compacted (evicted: %d)', evicted)
+            self.__compactAfterId = self.after(self.artCompactInterval * 1000, self.__compactArtCache)
+
+        def compactFailed(errmsg):
+            logging.error('Could not compact album art cache')
+            logging.error(errmsg)
+            self.__compactAfterId = self.after(self.artCompactInterval * 1000, self.__compactArtCache)
+
+        self._dispatcher.call(self._controller.compactArtCache,
+                              (self._controller.artCache.takeTouched(),),
+                              callback = compacted,
+                              errback = compactFailed)
+
+    def _showArtCacheStats(self):
+        try:
+            stats = self._controller.artCache.getStats()
+        except:
+            logging.error('Could not read album art cache statistics')
+            logging.error(traceback.format_exc())
+            return
+
+        message = 'Covers: %(art)d\n' \
+                  'Thumbnails: %(thumbnails)d\n' \
+                  'Size: %(size_kb).1f kB\n' \
+                  'Hit rate: %(hit_rate_pct).1f %% (%(hits)d hits, %(misses)d misses)' % dict(
+                      stats,
+                      size_kb = stats['size'] / 1024.0,
+                      hit_rate_pct = stats['hit_rate'] * 100)
+
+        tkMessageBox.showinfo(title = 'Album art cache...',
+                              message = message)
+
+    def _showConnectionStats(self):
+        stats = HTTP_POOL.getStats()
+
+        message = 'Requests: %(requests)d\n' \
+                  'Connections opened: %(created)d\n' \
+                  'Reused: %(reused)d (%(reuse_rate_pct).1f %%)\n' \
+                  'Idle now: %(idle)d\n' \
+                  'Closed after idle timeout: %(expired)d\n' \
+                  'Retried: %(retried)d, failed: %(failed)d' % dict(
+                      stats,
+                      reuse_rate_pct = stats['reuse_rate'] * 100)
+
+        tkMessageBox.showinfo(title = 'Connections...',
+                              message = message)
+
+    def _showDiagnostics(self):
+        if self._diagnostics is not None and self._diagnostics.winfo_exists():
+            self._diagnostics.deiconify()
+            self._diagnostics.lift()
+            return
+
+        self._diagnostics = DiagnosticsWindow(self, self._controller, self.__speakerName)
+
+    def __speakerName(self, ip):
+        for speaker in self.__listContent:
+            if speaker.speaker_ip == ip:
+                return str(speaker)
+
+        return ip
+
     def _updateButtons(self):
         logging.debug('Updating control buttons')
         speaker = self.__getSelectedSpeaker()
@@ -684,6 +2173,15 @@ class SonosList(tk.PanedWindow):
 
         self._filemenu.add_command(label="Scan for speakers",
                                    command=self.scanSpeakers)
+
+        self._filemenu.add_command(label="Album art cache",
+                                   command=self._showArtCacheStats)
+
+        self._filemenu.add_command(label="Connections",
+                                   command=self._showConnectionStats)
+
+        self._filemenu.add_command(label="Diagnostics",
+                                   command=self._showDiagnostics)
         
         self._filemenu.add_command(label="Exit",
                                    command=self._cleanExit)
@@ -704,6 +2202,11 @@ class SonosList(tk.PanedWindow):
         self._playbackmenu.add_command(label = "Next",
                                        command = self.__next)
 
+        self._playbackmenu.add_separator()
+
+        self._playbackmenu.add_command(label = "Refresh queue",
+                                       command = self.refreshQueue)
+
 
     def _playSelectedQueueItem(self, evt):
         try:
@@ -715,69 +2218,91 @@ class SonosList(tk.PanedWindow):
                 logging.warning('Could not get track or speaker (%s, %s)', track_index, speaker)
                 return
             
-            speaker.play_from_queue(track_index)
-            self.showSpeakerInfo(speaker, refresh_queue = False)
+            self.__sendCommand([speaker], 'play_from_queue', track_index)
         except:
             logging.error('Could not play queue item')
             logging.error(traceback.format_exc())
             tkMessageBox.showerror(title = 'Queue...',
                                    message = 'Error playing queue item, please check error log for description')
         
+    def __sendCommand(self, speakers, command, *args):
+        # Every speaker gets the command at once, a group takes as long as
+        # its slowest speaker. Results are collected per speaker and the
+        # failures reported together when the last one answered
+        fanOut = {
+            'command': command,
+            'waiting': set(speakers),
+            'results': {},
+            'errors': {},
+            'started': time.time(),
+            }
 
-    def __previous(self):
-        speaker = self.__getSelectedSpeaker()
-        if not speaker:
+        for speaker in speakers:
+            self._commandDispatcher.call(self._controller.runCommand,
+                                         (speaker, command) + args,
+                                         callback = lambda result, speaker = speaker: self.__commandSent(fanOut, speaker, result),
+                                         errback = lambda errmsg, speaker = speaker: self.__commandFailed(fanOut, speaker, errmsg))
+
+        return fanOut
+
+    def __commandSent(self, fanOut, speaker, result):
+        fanOut['waiting'].discard(speaker)
+        fanOut['results'][speaker] = result
+        if not fanOut['waiting']:
+            self.__commandFinished(fanOut)
+
+    def __commandFailed(self, fanOut, speaker, errmsg):
+        logging.error('Could not send command "%s" to "%s"', fanOut['command'], speaker)
+        logging.error(errmsg)
+
+        fanOut['waiting'].discard(speaker)
+        fanOut['errors'][speaker] = errmsg
+        if not fanOut['waiting']:
+            self.__commandFinished(fanOut)
+
+    def __commandFinished(self, fanOut):
+        logging.info('Command "%s" sent to %d speaker(s) in %.0f ms (%d failed)',
+                     fanOut['command'],
+                     len(fanOut['results']) + len(fanOut['errors']),
+                     (time.time() - fanOut['started']) * 1000,
+                     len(fanOut['errors']))
+
+        # With events flowing the speaker tells us what changed
+        speaker = self.__currentSpeaker
+        if speaker in fanOut['results'] and not self.__eventsActive(speaker):
+            self.showSpeakerInfo(speaker, refresh_queue = False)
+
+        if fanOut['errors']:
+            names = ', '.join(sorted(str(speaker) for speaker in fanOut['errors']))
+            tkMessageBox.showerror(title = 'Command...',
+                                   message = 'Error sending command to %s, please check error log for description' % names)
+
+    def __sendToSelected(self, command):
+        speakers = self.__getSelectedSpeakers()
+        if not speakers:
             raise SystemError('No speaker selected, this should not happend')
 
-        speaker.previous()
-        self.showSpeakerInfo(speaker, refresh_queue = False)
+        self.__sendCommand(speakers, command)
+
+    def __previous(self):
+        self.__sendToSelected('previous')
         
     def __next(self):
-        speaker = self.__getSelectedSpeaker()
-        if not speaker:
-            raise SystemError('No speaker selected, this should not happend')
-
-        speaker.next()
-        self.showSpeakerInfo(speaker, refresh_queue = False)
+        self.__sendToSelected('next')
 
     def __pause(self):
-        speaker = self.__getSelectedSpeaker()
-        if not speaker:
-            raise SystemError('No speaker selected, this should not happend')
-
-        speaker.pause()
-        self.showSpeakerInfo(speaker, refresh_queue = False)
+        self.__sendToSelected('pause')
 
     def __play(self):
-        speaker = self.__getSelectedSpeaker()
-        if not speaker:
-            raise SystemError('No speaker selected, this should not happend')
-
-        speaker.play()
-        self.showSpeakerInfo(speaker, refresh_queue = False)
+        self.__sendToSelected('play')
 
     def _loadSettings(self):
-        # Connect to database
-        dbPath = os.path.join(USER_DATA, 'SoCo-Tk.sqlite')
-
-        createStructure = False
-        if not os.path.exists(dbPath):
-            logging.info('Database "%s" not found, creating', dbPath)
-            createStructure = True
+        self._controller.open()
 
-            if not os.path.exists(USER_DATA):
-                logging.info('Creating directory structure')
-                os.makedirs(USER_DATA)
-
-        logging.info('Connecting: %s', dbPath)
-        self._connection = sql.connect(dbPath)
-        self._connection.row_factory = sql.Row
-
-        if createStructure:
-            self._createSettingsDB()
+        self.__compactAfterId = self.after(self.artCompactDelay * 1000, self.__compactArtCache)
 
         # Load window geometry
-        geometry = self.__getConfig('window_geometry')
+        geometry = self._controller.getConfig('window_geometry')
         if geometry:
             try:
                 logging.info('Found geometry "%s", applying', geometry)
@@ -786,20 +2311,15 @@ class SonosList(tk.PanedWindow):
                 logging.error('Could not set window geometry')
                 logging.error(traceback.format_exc())
 
-        # Load speakers
-        speakers = self._loadSpeakers()
+        # Load speakers, asking to scan waits until the window is shown
+        speakers = self._controller.loadSpeakers()
         if speakers:
             self.__addSpeakers(speakers)
         else:
-            message = 'No speakers found in your local configuration' \
-                      ', do you want to scan for speakers?'
-            
-            doscan = tkMessageBox.askyesno(title = 'Scan...',
-                                           message = message)
-            if doscan: self.scanSpeakers()
+            self.__deferStartup(self.__askScan)
 
         # Load last selected speaker
-        selected_speaker_uid = self.__getConfig('last_selected')
+        selected_speaker_uid = self._controller.getConfig('last_selected')
         logging.debug('Last selected speaker: %s', selected_speaker_uid)
 
         selectIndex = None
@@ -810,14 +2330,22 @@ class SonosList(tk.PanedWindow):
                 selectSpeaker = speaker
                 break
 
+        self._markStartup('settings')
+
+        # Everything shown before the first paint comes from the database,
+        # the speaker itself is only asked once the window is up
         if selectIndex is not None:
             self._listbox.selection_anchor(selectIndex)
             self._listbox.selection_set(selectIndex)
             self._listbox.see(selectIndex)
-            self.showSpeakerInfo(speaker)
+            self.__showCachedSpeakerInfo(selectSpeaker)
+            self.__startupSpeaker = selectSpeaker
+
+        self._markStartup('cached')
+        self.__deferStartup(self.__startLiveUpdates)
 
 ##        # Load sash_coordinates
-##        sashes = self.__getConfig('sash_coordinates')
+##        sashes = self._controller.getConfig('sash_coordinates')
 ##        if sashes:
 ##            for sash_info in sashes.split(','):
 ##                if len(sash_info) < 1: continue
@@ -831,130 +2359,85 @@ class SonosList(tk.PanedWindow):
 ##
 ##            
 
-    def _storeSpeakers(self, speakers):
-        logging.debug('Removing old speakers')
-        self._connection.execute('DELETE FROM speakers').close()
-        self._connection.commit()
-
-        __sql = '''
-            INSERT INTO speakers(
-                name,
-                ip,
-                uid,
-                serial,
-                mac
-            ) VALUES (?, ?, ?, ?, ?)
-        '''
-        
-        logging.debug('Storing speakers (size: %d)', len(speakers))
-        for speaker in speakers:
-            try:
-                params = (
-                    speaker.speaker_info['zone_name'],
-                    speaker.speaker_ip,
-                    speaker.speaker_info['uid'],
-                    speaker.speaker_info['serial_number'],
-                    speaker.speaker_info['mac_address'],
-                    )
-                self._connection.execute(__sql, params).close()
-            except:
-                logging.error('Could not insert speaker: %s', speaker)
-                logging.error(traceback.format_exc())
-                
-        self._connection.commit()
-        
-    def _loadSpeakers(self):
-        logging.info('Loading speakers from config')
-        __sql = '''
-            SELECT
-                speaker_id,
-                name,
-                ip,
-                uid,
-                serial,
-                mac
-            FROM speakers
-        '''
-
-        speakers = []
-        with clib.closing(self._connection.execute(__sql)) as cur:
-            for row in cur:
-                speaker_id = None
-                try:
-                    speaker_id = row['speaker_id']
-                    speaker = WrappedSoCo(row['ip'], get_info = False)
-                    speaker.speaker_info['zone_name'] =         row['name']
-                    speaker.speaker_info['uid'] =               row['uid']
-                    speaker.speaker_info['serial_number'] =     row['serial']
-                    speaker.speaker_info['mac_address'] =       row['mac']
-                    speakers.append(speaker)
-                except:
-                    logging.error('Could not load speaker (id: %s)' % speaker_id)
-                    logging.error(traceback.format_exc())
+    def __deferStartup(self, func):
+        # after_idle alone may run before Tk got to draw the window
+        self.after_idle(lambda: self.after(0, func))
 
-        return speakers
+    def __askScan(self):
+        message = 'No speakers found in your local configuration' \
+                  ', do you want to scan for speakers?'
 
-    def __setConfig(self, settingName, value):
-        assert settingName is not None
+        doscan = tkMessageBox.askyesno(title = 'Scan...',
+                                       message = message)
+        if doscan: self.scanSpeakers()
 
-        __sql = 'INSERT OR REPLACE INTO config (name, value) VALUES (?, ?)'
+    def __startLiveUpdates(self):
+        self.update_idletasks()
+        self._markStartup('first_paint')
+        reportImportProfile(self.startupTimings['first_paint'])
 
-        self._connection.execute(__sql, (settingName, value)).close()
-        self._connection.commit()
-        
-    def __getConfig(self, settingName):
-        assert settingName is not None
+        speaker = self.__startupSpeaker
+        self.__startupSpeaker = None
 
-        __sql = 'SELECT value FROM config WHERE name = ? LIMIT 1'
+        if self.measureStartup:
+            self.after(self.measureStartupTimeout * 1000, self.__reportStartup)
+            if speaker is None:
+                self.__reportStartup()
 
-        with clib.closing(self._connection.execute(__sql, (settingName, ))) as cur:
-            row = cur.fetchone()
+        if speaker is not None and speaker is self.__getSelectedSpeaker():
+            self.showSpeakerInfo(speaker)
 
-            if not row:
-                return None
-            
-            return row['value']
-
-    def _createSettingsDB(self):
-        logging.debug('Creating tables')
-        self._connection.executescript('''
-            CREATE TABLE IF NOT EXISTS config(
-                config_id   INTEGER,
-                name        TEXT UNIQUE,
-                value       TEXT,
-                PRIMARY KEY(config_id)
-            );
-                
-            CREATE TABLE IF NOT EXISTS speakers(
-                speaker_id  INTEGER,
-                name        TEXT,
-                ip          TEXT,
-                uid         TEXT,
-                serial      TEXT,
-                mac         TEXT,
-                PRIMARY KEY(speaker_id)
-            );
-                
-            CREATE TABLE IF NOT EXISTS images(
-                image_id        INTEGER,
-                uri             TEXT UNIQUE,
-                image           BLOB,
-                PRIMARY KEY(image_id)
-            );
-        ''').close()
-
-        logging.debug('Creating index')
-        self._connection.execute('''
-            CREATE INDEX IF NOT EXISTS idx_image_uri ON images(uri)
-        ''').close()
-
-        self._connection.execute('''
-            CREATE INDEX IF NOT EXISTS idx_config_name ON config(name)
-        ''').close()
-
-def main(root):
+    def _markStartup(self, name):
+        # Seconds since the process started, only the first time counts
+        if name in self.startupTimings:
+            return
+
+        self.startupTimings[name] = time.time() - STARTUP_TIME
+        logging.debug('Startup: %s after %.0f ms', name, self.startupTimings[name] * 1000)
+
+        if self.measureStartup and\
+           'live_track' in self.startupTimings and\
+           'live_queue' in self.startupTimings:
+            self.__reportStartup()
+
+    def __reportStartup(self):
+        if not self.measureStartup:
+            return
+        self.measureStartup = False
+
+        timings = sorted(self.startupTimings.items(), key = lambda item: item[1])
+        for name, elapsed in timings:
+            print '%-12s %8.1f ms' % (name, elapsed * 1000)
+
+        self.__parent.quit()
+
+    def __showCachedSpeakerInfo(self, speaker):
+        state = self._controller.getSpeakerState(speaker)
+        if not state:
+            return
+
+        logging.info('Showing last known state of "%s"', speaker)
+        self.__cachedInfoSpeaker = speaker
+        for info in ('title', 'artist', 'album'):
+            self._infoWidget[info].config(text = state.get(info) or self.empty_info)
+
+        # Decoding art is the slow part, skip it if we are late already
+        if time.time() - STARTUP_TIME > self.startupBudget:
+            logging.info('Startup budget used up, not showing cached album art')
+            return
+
+        if state.get('album_art'):
+            self.__setAlbumArt(state['album_art'],
+                               track_uri = state.get('uri'),
+                               album_key = self._controller.getAlbumKey(state),
+                               download = False)
+
+        
+        
+def main(root, measure_startup = False):
     logging.debug('Main')
     sonosList = SonosList(root)
+    sonosList.measureStartup = measure_startup
     sonosList.mainloop()
     sonosList.destroy()
 
@@ -965,7 +2448,7 @@ if __name__ == '__main__':
     try:
         root.wm_title('SoCo')
         root.minsize(800,400)
-        main(root)
+        main(root, measure_startup = '--measure-startup' in sys.argv)
 ##    except:
 ##        logging.debug(traceback.format_exc())
     finally:
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+# Times what SoCo-Tk does while you wait: scanning for speakers, showing a
+# speaker, loading and refreshing its queue and finding album art, against
+# fake speakers from fake_sonos.py so the numbers only depend on our code
+# and the latency asked for. Results can be saved with --output and
+# compared with an earlier run (another commit) with --compare
+
+import logging, traceback
+import os, sys
+import platform
+import subprocess
+import tempfile
+import shutil
+import json
+import time
+
+import fake_sonos
+from soco_controller import SonosController, HTTP_POOL, findSoCo, loadImaging, openImage
+
+CASES = ('scan', 'status', 'speaker_info', 'queue_load', 'queue_refresh', 'queue_cached', 'art_cold', 'art_warm')
+
+class BenchmarkController(SonosController):
+    # Scans the fake speakers instead of asking the network
+    def __init__(self, ips = ()):
+        SonosController.__init__(self)
+        self.ips = list(ips)
+
+    def discoverIps(self):
+        return list(self.ips)
+
+
+class Benchmark(object):
+    def __init__(self, cases = CASES, repeat = 5, latency = 0.0, pageSize = 100, thumbSize = (150, 150)):
+        self.cases = set(cases)
+        self.repeat = repeat
+        self.latency = latency
+        self.pageSize = pageSize
+        self.thumbSize = thumbSize
+        self.results = []
+
+        self.__directory = None
+        self.__controller = None
+        self.__speakers = []
+
+    def start(self, speakerCount):
+        self.__directory = tempfile.mkdtemp(prefix = 'soco-benchmark-')
+        self.__speakers = fake_sonos.startSpeakers(speakerCount, latency = self.latency)
+
+        self.__controller = BenchmarkController()
+        self.__controller.open(os.path.join(self.__directory, 'benchmark.sqlite'))
+
+    def stop(self):
+        if self.__controller:
+            self.__controller.close()
+            self.__controller = None
+
+        fake_sonos.stopSpeakers(self.__speakers)
+        self.__speakers = []
+
+        if self.__directory:
+            shutil.rmtree(self.__directory, ignore_errors = True)
+            self.__directory = None
+
+    def measure(self, case, params, func, setup = None):
+        if case not in self.cases:
+            return None
+
+        samples = []
+        for run in xrange(self.repeat):
+            args = setup(run) if setup else ()
+
+            started = time.time()
+            func(*args)
+            samples.append(time.time() - started)
+
+        samples.sort()
+        middle = len(samples) / 2
+        median = samples[middle] if len(samples) % 2 else (samples[middle - 1] + samples[middle]) / 2
+
+        result = {
+            'case': case,
+            'params': params,
+            'samples': samples,
+            'min': samples[0],
+            'median': median,
+            'mean': sum(samples) / len(samples),
+            'max': samples[-1],
+            }
+        self.results.append(result)
+        printResult(result)
+        return result
+
+    def scan(self, speakerCount):
+        # scanSpeakers: probe every ip at once and remember what answered
+        controller = self.__controller
+        controller.ips = [speaker.ip for speaker in self.__speakers[:speakerCount]]
+
+        def scan():
+            speakers = controller.scan()
+            if len(speakers) != speakerCount:
+                raise RuntimeError('Found %d of %d speakers' % (len(speakers), speakerCount))
+            controller.storeSpeakers(speakers)
+
+        self.measure('scan', {'speakers': speakerCount}, scan)
+
+    def status(self, speakerCount):
+        # Track info of every speaker at once, like the command line does
+        controller = self.__controller
+        controller.ips = [speaker.ip for speaker in self.__speakers[:speakerCount]]
+        speakers = controller.scan()
+
+        def status():
+            for speaker, track, errmsg in controller.runAll(controller.getTrackInfo, speakers, workers = 32):
+                if errmsg is not None:
+                    raise RuntimeError(errmsg)
+
+        self.measure('status', {'speakers': speakerCount}, status)
+
+    def queue(self, queueSize):
+        controller = self.__controller
+        fake = self.__speakers[0]
+        fake.setQueue(queueSize)
+        controller.ips = [fake.ip]
+        speaker = controller.scan()[0]
+        params = {'queue': queueSize}
+
+        # showSpeakerInfo: track info and the first queue page are
+        # requested together, the speaker is shown once both arrived
+        calls = ((controller.getTrackInfo, ()),
+                 (controller.getQueue, (0, self.pageSize)))
+        def speakerInfo():
+            for call, result, errmsg in controller.runAll(lambda call: call[0](speaker, *call[1]), calls):
+                if errmsg is not None:
+                    raise RuntimeError(errmsg)
+
+        self.measure('speaker_info', params, speakerInfo)
+
+        # Scrolling to the end of the queue, one page after another
+        def queueLoad():
+            queue = []
+            while True:
+                page = controller.getQueue(speaker, len(queue), self.pageSize)
+                queue.extend(page)
+                if len(page) < self.pageSize:
+                    return queue
+
+        queue = queueLoad()
+        if len(queue) != queueSize:
+            raise RuntimeError('Loaded %d of %d queue items' % (len(queue), queueSize))
+
+        self.measure('queue_load', params, queueLoad)
+
+        # refreshQueue on an unchanged queue
+        uris = [item['uri'] for item in queue]
+        self.measure('queue_refresh', params,
+                     lambda: controller.fetchQueueChanges(speaker, uris, self.pageSize))
+
+        # Selecting a speaker whose queue is stored: read it back and
+        # check its update id with the speaker
+        updateId, total = controller.getQueueVersion(speaker)
+        controller.storeQueueCache(speaker, updateId, total, queue)
+        controller.flush()
+
+        def queueCached():
+            cached = controller.loadQueueCache(speaker)
+            if (cached['update_id'], cached['total']) != controller.getQueueVersion(speaker):
+                raise RuntimeError('Cached queue is out of date')
+
+        self.measure('queue_cached', params, queueCached)
+
+    def albumArt(self):
+        controller = self.__controller
+        fake = self.__speakers[0]
+
+        # A different album for every cold run, so nothing is cached yet
+        fake.setQueue(self.repeat * fake.albumSize)
+        tracks = []
+        for item in fake.queue[::fake.albumSize]:
+            track = dict(item)
+            track['album_art'] = 'http://%s:1400%s' % (fake.ip, item['album_art'])
+            tracks.append(track)
+
+        # Fetch the covers once so cold runs measure us and not drawing them
+        for track in tracks:
+            HTTP_POOL.fetch(track['album_art'])
+
+        params = {'art_size': fake.artSize, 'thumb_size': list(self.thumbSize)}
+
+        self.measure('art_cold', params,
+                     lambda track: loadAlbumArt(controller, track, self.thumbSize),
+                     lambda run: (tracks[run],))
+        if 'art_cold' not in self.cases:
+            for track in tracks:
+                loadAlbumArt(controller, track, self.thumbSize)
+
+        controller.flush()
+        self.measure('art_warm', params,
+                     lambda track: loadAlbumArt(controller, track, self.thumbSize, download = False),
+                     lambda run: (tracks[run],))
+
+
+def loadAlbumArt(controller, track, thumbSize, download = True):
+    # What SonosList.__setAlbumArt and __albumArtDecoded do, without the
+    # Tk photo and the worker: look the cover up, otherwise download,
+    # resize and store it
+    url = track['album_art']
+    sources = (url, controller.getAlbumKey(track))
+
+    art_hash, thumbnail, raw_data = controller.findCachedArt(track['uri'], sources, thumbSize)
+    if thumbnail is not None:
+        image = openImage(thumbnail)
+        image.load()
+        return image
+
+    if not download:
+        raise RuntimeError('Album art for "%s" not cached' % track['uri'])
+
+    controller.artCache.recordMiss()
+    result = controller.fetchAlbumArt(url, thumbSize)
+    controller.storeAlbumArt(result, thumbSize, [track['uri']], sources)
+    return result[2]
+
+def printResult(result):
+    params = ' '.join('%s=%s' % (name, value) for name, value in sorted(result['params'].items()))
+    print '%-14s %-28s %9.1f %9.1f %9.1f %9.1f' % (
+        result['case'],
+        params,
+        result['min'] * 1000,
+        result['median'] * 1000,
+        result['mean'] * 1000,
+        result['max'] * 1000)
+
+def resultKey(result):
+    return (result['case'], tuple(sorted((name, str(value)) for name, value in result['params'].items())))
+
+def compare(results, baseline):
+    # Median against median, the other numbers are noisier
+    baselineResults = dict((resultKey(result), result) for result in baseline['results'])
+
+    print
+    print 'Compared with %s (%s)' % (baseline.get('commit') or '?', baseline.get('date') or '?')
+    for result in results:
+        old = baselineResults.get(resultKey(result))
+        params = ' '.join('%s=%s' % (name, value) for name, value in sorted(result['params'].items()))
+        if old is None:
+            print '%-14s %-28s %9s' % (result['case'], params, 'new')
+            continue
+
+        change = (result['median'] - old['median']) / old['median'] * 100 if old['median'] else 0.0
+        print '%-14s %-28s %9.1f -> %9.1f ms %+7.1f%%' % (
+            result['case'],
+            params,
+            old['median'] * 1000,
+            result['median'] * 1000,
+            change)
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       stderr = open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parseList(value):
+    return [int(item) for item in value.split(',') if item]
+
+def main(argv = None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Benchmark SoCo-Tk against fake speakers')
+    parser.add_argument('--speakers', type = parseList, default = [1, 10, 100], help = 'speaker counts, comma separated')
+    parser.add_argument('--queue', type = parseList, default = [10, 1000, 10000], help = 'queue sizes, comma separated')
+    parser.add_argument('--latency', type = float, default = 0.002, help = 'seconds a fake speaker takes per request')
+    parser.add_argument('--repeat', type = int, default = 5, help = 'runs per case')
+    parser.add_argument('--cases', default = ','.join(CASES), help = 'cases to run, comma separated')
+    parser.add_argument('--output', help = 'save the results as json')
+    parser.add_argument('--compare', help = 'results of an earlier run to compare with')
+    parser.add_argument('--verbose', '-v', action = 'store_true', help = 'log everything')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format = '%(asctime)s %(levelname)10s: %(message)s',
+                        level = logging.DEBUG if args.verbose else logging.ERROR)
+
+    cases = set(args.cases.split(','))
+    unknown = cases.difference(CASES)
+    if unknown:
+        parser.error('Unknown case(s): %s' % ', '.join(sorted(unknown)))
+
+    if not findSoCo():
+        print >> sys.stderr, 'Could not find SoCo library, make sure you have installed SoCo!'
+        return 1
+
+    if cases.intersection(('art_cold', 'art_warm')) and not loadImaging():
+        print >> sys.stderr, 'python-imaging is needed for the album art cases'
+        return 1
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    benchmark = Benchmark(cases, repeat = max(1, args.repeat), latency = args.latency)
+    print '%-14s %-28s %9s %9s %9s %9s' % ('case', 'params', 'min ms', 'median', 'mean', 'max')
+    try:
+        if cases.intersection(('scan', 'status')):
+            benchmark.start(max(args.speakers + [1]))
+        else:
+            benchmark.start(1)
+
+        if cases.intersection(('scan', 'status')):
+            for speakerCount in args.speakers:
+                benchmark.scan(speakerCount)
+                benchmark.status(speakerCount)
+
+        if cases.intersection(('speaker_info', 'queue_load', 'queue_refresh', 'queue_cached')):
+            for queueSize in args.queue:
+                benchmark.queue(queueSize)
+
+        if cases.intersection(('art_cold', 'art_warm')):
+            benchmark.albumArt()
+    except:
+        logging.error(traceback.format_exc())
+        print >> sys.stderr, 'Benchmark failed: %s' % sys.exc_info()[1]
+        return 1
+    finally:
+        benchmark.stop()
+
+    results = benchmark.results
+    if baseline is not None:
+        compare(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': gitCommit(),
+                'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'latency': args.latency,
+                'repeat': args.repeat,
+                'results': results,
+                }, f, indent = 2, sort_keys = True)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
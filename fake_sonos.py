@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+
+# A stand-in zone player for benchmarks and trying things out without
+# speakers: answers the device description, the AVTransport,
+# RenderingControl and ContentDirectory SOAP calls SoCo-Tk makes, album
+# art urls and event subscriptions, whose events it sends when asked to
+# with notify(). Every speaker listens on port 1400 of its own loopback
+# address (127.0.1.1, 127.0.1.2, ...) like a real one does on the
+# network, which works out of the box on Linux
+
+import logging
+import sys
+import re
+import time
+import threading
+import uuid
+import urllib
+import urlparse
+import httplib
+import StringIO as sio
+import BaseHTTPServer
+import SocketServer
+import xml.sax.saxutils as saxutils
+
+NS_SOAP = 'http://schemas.xmlsoap.org/soap/envelope/'
+
+SERVICES = {
+    '/MediaRenderer/AVTransport/Control': 'urn:schemas-upnp-org:service:AVTransport:1',
+    '/MediaRenderer/RenderingControl/Control': 'urn:schemas-upnp-org:service:RenderingControl:1',
+    '/MediaServer/ContentDirectory/Control': 'urn:schemas-upnp-org:service:ContentDirectory:1',
+    '/DeviceProperties/Control': 'urn:schemas-upnp-org:service:DeviceProperties:1',
+    }
+
+EVENTS = {
+    '/MediaRenderer/AVTransport/Event': 'transport',
+    '/MediaRenderer/RenderingControl/Event': 'rendering',
+    '/MediaRenderer/Queue/Event': 'queue',
+    '/MediaServer/ContentDirectory/Event': 'content',
+    }
+
+EVENT_TEMPLATE = '<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">'\
+                 '<e:property><LastChange>%s</LastChange></e:property>'\
+                 '</e:propertyset>'
+
+LAST_CHANGE = {
+    'transport': '<Event xmlns="urn:schemas-upnp-org:metadata-1-0/AVT/"><InstanceID val="0">'\
+                 '<TransportState val="%(state)s"/>'\
+                 '<CurrentTrackURI val="%(uri)s"/>'\
+                 '<CurrentTrackMetaData val="%(metadata)s"/>'\
+                 '</InstanceID></Event>',
+    'rendering': '<Event xmlns="urn:schemas-upnp-org:metadata-1-0/RCS/"><InstanceID val="0">'\
+                 '<Volume channel="Master" val="%(volume)s"/>'\
+                 '<Volume channel="LF" val="100"/>'\
+                 '</InstanceID></Event>',
+    'queue':     '<Event xmlns="urn:schemas-sonos-com:metadata-1-0/Queue/"><QueueID val="0">'\
+                 '<UpdateID val="%(update_id)s"/>'\
+                 '</QueueID></Event>',
+    }
+
+DIDL_HEADER = '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" '\
+              'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" '\
+              'xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" '\
+              'xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">'
+
+ITEM_TEMPLATE = '<item id="Q:0/%(number)d" parentID="Q:0" restricted="true">'\
+                '<res protocolInfo="x-file-cifs:*:audio/mpeg:*" duration="%(duration)s">%(uri)s</res>'\
+                '<upnp:albumArtURI>%(art)s</upnp:albumArtURI>'\
+                '<dc:title>%(title)s</dc:title>'\
+                '<upnp:class>object.item.audioItem.musicTrack</upnp:class>'\
+                '<dc:creator>%(artist)s</dc:creator>'\
+                '<upnp:album>%(album)s</upnp:album>'\
+                '</item>'
+
+# Covers are drawn once per album and shared by every fake speaker
+_artLock = threading.Lock()
+_art = {}
+
+def makeArt(album, size):
+    with _artLock:
+        key = (album, size)
+        if key not in _art:
+            import PIL.Image, PIL.ImageDraw
+
+            # A gradient per album, flat colours would compress to
+            # nothing and make decoding look cheaper than it is
+            seed = hash(album)
+            image = PIL.Image.new('RGB', (size, size))
+            draw = PIL.ImageDraw.Draw(image)
+            for y in xrange(0, size, 4):
+                draw.rectangle((0, y, size, y + 3),
+                               fill = ((seed + y) % 256, (seed >> 8) % 256, (y * 3) % 256))
+            draw.ellipse((size / 4, size / 4, size * 3 / 4, size * 3 / 4),
+                         fill = ((seed >> 16) % 256, 255 - (seed % 256), 128))
+
+            output = sio.StringIO()
+            image.save(output, 'JPEG', quality = 90)
+            _art[key] = output.getvalue()
+
+        return _art[key]
+
+
+class FakeSpeaker(object):
+    def __init__(self, ip, number = 1, queueSize = 100, latency = 0.0, albumSize = 10, artSize = 600):
+        self.ip = ip
+        self.number = number
+        self.name = 'Fake %d' % number
+        self.uid = 'RINCON_FAKE%010d01400' % number
+        self.latency = latency
+        self.albumSize = albumSize
+        self.artSize = artSize
+
+        self.queue = [self.makeItem(index) for index in xrange(queueSize)]
+        self.updateId = 1
+        self.position = 0
+        self.transportState = 'PLAYING'
+        self.volume = 20
+        self.mute = False
+
+        self.requests = 0
+        self.subscriptions = {}
+        self.__lock = threading.Lock()
+        self.__server = None
+
+    def makeItem(self, index):
+        album = index / self.albumSize
+        uri = 'x-file-cifs://fake/music/album%d/track%d.mp3' % (album, index)
+        return {
+            'uri': uri,
+            'title': 'Track %d' % index,
+            'artist': 'Artist %d' % (album % 50),
+            'album': 'Album %d' % album,
+            'album_art': '/getaa?s=1&u=%s' % urllib.quote(uri, ''),
+            'duration': '0:03:%02d' % (index % 60),
+            }
+
+    def start(self):
+        self.__server = _FakeServer((self.ip, 1400), _FakeHandler)
+        self.__server.speaker = self
+
+        thread = threading.Thread(target = self.__server.serve_forever,
+                                  name = 'FakeSonos-%s' % self.ip)
+        thread.setDaemon(True)
+        thread.start()
+        logging.info('Fake speaker "%s" listening on %s:1400', self.name, self.ip)
+
+    def stop(self):
+        if self.__server:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def setQueue(self, queueSize):
+        with self.__lock:
+            self.queue = [self.makeItem(index) for index in xrange(queueSize)]
+            self.position = min(self.position, max(0, queueSize - 1))
+            self.updateId += 1
+
+    def didl(self, items, start = 0):
+        content = []
+        for number, item in enumerate(items, start + 1):
+            values = dict((key, saxutils.escape(value)) for key, value in item.items())
+            values['number'] = number
+            values['art'] = saxutils.escape(item['album_art'])
+            content.append(ITEM_TEMPLATE % values)
+
+        return DIDL_HEADER + ''.join(content) + '</DIDL-Lite>'
+
+    def eventBody(self, service):
+        # The LastChange a speaker sends for service, with its state now
+        with self.__lock:
+            item = self.queue[self.position] if self.queue else None
+            values = {
+                'state': self.transportState,
+                'uri': item['uri'] if item else '',
+                'metadata': self.didl([item], self.position) if item else '',
+                'volume': self.volume,
+                'update_id': self.updateId,
+                }
+
+        values = dict((key, saxutils.escape(unicode(value), {'"': '&quot;'})) for key, value in values.items())
+        return (EVENT_TEMPLATE % saxutils.escape(LAST_CHANGE[service] % values)).encode('utf-8')
+
+    def notify(self, service):
+        # Sends the state of service to everyone subscribed to it, like a
+        # speaker does after something changed. Returns how many got it
+        sids = [sid for sid, subscription in self.subscriptions.items()
+                if subscription['service'] == service]
+        for sid in sids:
+            self.sendEvent(sid, self.eventBody(service))
+
+        return len(sids)
+
+    def sendEvent(self, sid, body):
+        # Every subscription counts its events from 0, the first one is
+        # what a speaker sends right after subscribing
+        subscription = self.subscriptions[sid]
+        seq = subscription['seq']
+        subscription['seq'] += 1
+
+        url = urlparse.urlsplit(subscription['callback'].strip('<>'))
+        connection = httplib.HTTPConnection(url.hostname, url.port, timeout = 5)
+        try:
+            connection.request('NOTIFY', url.path, body, {
+                'Content-Type': 'text/xml; charset="utf-8"',
+                'NT': 'upnp:event',
+                'NTS': 'upnp:propchange',
+                'SID': sid,
+                'SEQ': str(seq),
+                })
+            return connection.getresponse().status
+        finally:
+            connection.close()
+
+    def supportInfo(self):
+        return '''<?xml version="1.0" ?>
+<ZPSupportInfo><ZPInfo>
+<ZoneName>%s</ZoneName>
+<ZoneIcon>x-rincon-roomicon:living</ZoneIcon>
+<LocalUID>%s</LocalUID>
+<SerialNumber>00-00-00-00-00-%02X:F</SerialNumber>
+<SoftwareVersion>26.1-76230</SoftwareVersion>
+<HardwareVersion>1.8.1.2-2</HardwareVersion>
+<MACAddress>00:00:00:00:00:%02X</MACAddress>
+</ZPInfo></ZPSupportInfo>''' % (self.name, self.uid, self.number % 256, self.number % 256)
+
+    def deviceDescription(self):
+        return '''<?xml version="1.0" encoding="utf-8" ?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+<specVersion><major>1</major><minor>0</minor></specVersion>
+<device>
+<deviceType>urn:schemas-upnp-org:device:ZonePlayer:1</deviceType>
+<friendlyName>%s - Fake</friendlyName>
+<manufacturer>Sonos, Inc.</manufacturer>
+<modelName>Fake Play:5</modelName>
+<roomName>%s</roomName>
+<UDN>uuid:%s</UDN>
+</device>
+</root>''' % (self.ip, self.name, self.uid)
+
+    def call(self, service, action, arguments):
+        # Returns the response arguments as (name, value) pairs, raises
+        # KeyError for actions a fake does not know
+        with self.__lock:
+            if action == 'GetPositionInfo':
+                if not self.queue:
+                    return [('Track', 0), ('TrackDuration', '0:00:00'), ('TrackMetaData', ''),
+                            ('TrackURI', ''), ('RelTime', '0:00:00')]
+
+                item = self.queue[self.position]
+                return [('Track', self.position + 1),
+                        ('TrackDuration', item['duration']),
+                        ('TrackMetaData', self.didl([item], self.position)),
+                        ('TrackURI', item['uri']),
+                        ('RelTime', '0:00:%02d' % (int(time.time()) % 60))]
+            elif action == 'GetTransportInfo':
+                return [('CurrentTransportState', self.transportState),
+                        ('CurrentTransportStatus', 'OK'),
+                        ('CurrentSpeed', 1)]
+            elif action in ('Play', 'Pause', 'Stop'):
+                self.transportState = {'Play': 'PLAYING', 'Pause': 'PAUSED_PLAYBACK', 'Stop': 'STOPPED'}[action]
+                return []
+            elif action == 'Next':
+                self.position = min(self.position + 1, max(0, len(self.queue) - 1))
+                return []
+            elif action == 'Previous':
+                self.position = max(self.position - 1, 0)
+                return []
+            elif action == 'Seek':
+                if arguments.get('Unit') == 'TRACK_NR':
+                    self.position = min(max(int(arguments['Target']) - 1, 0), max(0, len(self.queue) - 1))
+                return []
+            elif action == 'SetAVTransportURI':
+                return []
+            elif action == 'RemoveAllTracksFromQueue':
+                self.queue = []
+                self.position = 0
+                self.updateId += 1
+                return []
+            elif action == 'GetVolume':
+                return [('CurrentVolume', self.volume)]
+            elif action == 'SetVolume':
+                self.volume = int(arguments['DesiredVolume'])
+                return []
+            elif action == 'GetMute':
+                return [('CurrentMute', int(self.mute))]
+            elif action == 'SetMute':
+                self.mute = arguments['DesiredMute'] == '1'
+                return []
+            elif action == 'Browse':
+                start = int(arguments.get('StartingIndex', 0))
+                count = int(arguments.get('RequestedCount', 100)) or len(self.queue)
+                items = self.queue[start:start + count]
+                return [('Result', self.didl(items, start)),
+                        ('NumberReturned', len(items)),
+                        ('TotalMatches', len(self.queue)),
+                        ('UpdateID', self.updateId)]
+            elif action == 'SetLEDState':
+                return []
+
+        raise KeyError(action)
+
+    def subscribe(self, service, callback, timeout):
+        sid = 'uuid:RINCON_FAKE-%s' % uuid.uuid4()
+        self.subscriptions[sid] = {
+            'service': service,
+            'callback': callback,
+            'timeout': timeout,
+            'seq': 0,
+            }
+        return sid
+
+    def unsubscribe(self, sid):
+        return self.subscriptions.pop(sid, None) is not None
+
+
+class _FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Replies go out in one piece without waiting for acks, otherwise
+    # Nagle and delayed acks add 40 ms a request a real speaker does not
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        speaker = self.__begin()
+
+        url = urlparse.urlparse(self.path)
+        if url.path == '/status/zp':
+            self.__reply(200, speaker.supportInfo())
+        elif url.path == '/xml/device_description.xml':
+            self.__reply(200, speaker.deviceDescription())
+        elif url.path == '/getaa':
+            uri = urlparse.parse_qs(url.query).get('u', [''])[0]
+            match = re.search(r'/album(\d+)/', uri)
+            if match is None:
+                self.__reply(404, 'Not found', 'text/plain')
+                return
+
+            self.__reply(200, makeArt(match.group(1), speaker.artSize), 'image/jpeg')
+        else:
+            self.__reply(404, 'Not found', 'text/plain')
+
+    def do_POST(self):
+        speaker = self.__begin()
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+
+        service = SERVICES.get(self.path)
+        soapAction = (self.headers.getheader('soapaction') or '').strip('"')
+        action = soapAction.split('#')[-1]
+        arguments = dict(re.findall(r'<(\w+)>([^<]*)</\1>', body))
+
+        try:
+            if service is None:
+                raise KeyError(self.path)
+            result = speaker.call(service, action, arguments)
+        except KeyError:
+            self.__reply(500, self.__envelope('<s:Fault><faultcode>s:Client</faultcode>'
+                                              '<faultstring>UPnPError</faultstring><detail>'
+                                              '<UPnPError xmlns="urn:schemas-upnp-org:control-1-0">'
+                                              '<errorCode>401</errorCode></UPnPError>'
+                                              '</detail></s:Fault>'))
+            return
+
+        values = ''.join('<%s>%s</%s>' % (name, saxutils.escape(unicode(value).encode('utf-8')), name)
+                         for name, value in result)
+        self.__reply(200, self.__envelope('<u:%sResponse xmlns:u="%s">%s</u:%sResponse>' % (
+            action, service, values, action)))
+
+    def do_SUBSCRIBE(self):
+        speaker = self.__begin()
+
+        service = EVENTS.get(self.path)
+        if service is None:
+            self.__reply(404, 'Not found', 'text/plain')
+            return
+
+        sid = self.headers.getheader('sid')
+        if sid:
+            if sid not in speaker.subscriptions:
+                self.__reply(412, '', 'text/plain')
+                return
+            speaker.subscriptions[sid]['timeout'] = self.headers.getheader('timeout')
+        else:
+            sid = speaker.subscribe(service,
+                                    self.headers.getheader('callback'),
+                                    self.headers.getheader('timeout'))
+
+        self.send_response(200)
+        self.send_header('SID', sid)
+        self.send_header('TIMEOUT', 'Second-1800')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_UNSUBSCRIBE(self):
+        speaker = self.__begin()
+        if speaker.unsubscribe(self.headers.getheader('sid')):
+            self.__reply(200, '', 'text/plain')
+        else:
+            self.__reply(412, '', 'text/plain')
+
+    def log_message(self, format, *args):
+        logging.debug('Fake %s: %s', self.server.speaker.ip, format % args)
+
+    def __begin(self):
+        speaker = self.server.speaker
+        speaker.requests += 1
+        if speaker.latency:
+            time.sleep(speaker.latency)
+        return speaker
+
+    def __envelope(self, content):
+        return '<?xml version="1.0"?><s:Envelope xmlns:s="%s" '\
+               's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'\
+               '<s:Body>%s</s:Body></s:Envelope>' % (NS_SOAP, content)
+
+    def __reply(self, status, body, contentType = 'text/xml; charset="utf-8"'):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64
+
+
+def speakerIp(number):
+    return '127.0.%d.%d' % (1 + (number - 1) / 250, 1 + (number - 1) % 250)
+
+def startSpeakers(count, queueSize = 100, latency = 0.0, **kwargs):
+    speakers = []
+    for number in xrange(1, count + 1):
+        speaker = FakeSpeaker(speakerIp(number), number, queueSize, latency, **kwargs)
+        speaker.start()
+        speakers.append(speaker)
+
+    return speakers
+
+def stopSpeakers(speakers):
+    # Each server takes up to half a second to notice, stop them together
+    threads = [threading.Thread(target = speaker.stop) for speaker in speakers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def main(argv = None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Run fake Sonos speakers on loopback addresses')
+    parser.add_argument('--speakers', type = int, default = 3, help = 'number of speakers')
+    parser.add_argument('--queue', type = int, default = 100, help = 'queue items per speaker')
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'seconds added to every request')
+    parser.add_argument('--verbose', '-v', action = 'store_true', help = 'log every request')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format = '%(asctime)s %(levelname)10s: %(message)s',
+                        level = logging.DEBUG if args.verbose else logging.INFO)
+
+    speakers = startSpeakers(args.speakers, args.queue, args.latency)
+    print 'Listening on: %s' % ' '.join(speaker.ip for speaker in speakers)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopSpeakers(speakers)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
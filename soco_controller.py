@@ -0,0 +1,2371 @@
+#!/usr/bin/env python
+
+# The part of SoCo-Tk that does not need a window: finding speakers and
+# remembering them, reading track info and queues, caching album art and
+# talking to the speakers. SoCo-tk.py is a view on top of it, running
+# this file directly gives a command line for the same things
+
+import logging, traceback
+import imp
+import platform, os, sys
+import StringIO as sio
+import threading
+import Queue
+import time
+import bisect
+import itertools
+import re
+import hashlib
+import difflib
+import socket
+import errno
+import httplib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import json
+import xml.etree.cElementTree as XML
+
+import sqlite3 as sql
+import contextlib as clib
+import zlib
+
+# soco (which pulls in requests) and PIL are only imported once a speaker
+# or a cover actually needs them, finding them is enough to start
+soco = None
+
+def findSoCo():
+    try:
+        imp.find_module('soco')
+    except ImportError:
+        logging.warning('Could not find soco, trying from local file')
+        sys.path.append('./SoCo')
+        try:
+            imp.find_module('soco')
+        except ImportError:
+            logging.error('Could not find SoCo library')
+            return False
+
+    return True
+
+def importSoCo():
+    global soco
+    if soco is None:
+        logging.debug('Importing soco')
+        import soco as module
+        module.requests = PooledRequests(HTTP_POOL)
+        soco = module
+
+    return soco
+
+Image = None
+_imagingFailed = False
+
+def loadImaging():
+    global Image, _imagingFailed
+    if Image is not None:
+        return True
+    if _imagingFailed:
+        return False
+
+    try:
+        logging.debug('Importing PIL')
+        from PIL import Image as imageModule
+        Image = imageModule
+        return True
+    except:
+        logging.error('Could not import PIL')
+        logging.error(traceback.format_exc())
+        _imagingFailed = True
+        return False
+
+def openImage(data):
+    if not loadImaging():
+        raise ImportError('PIL is not available')
+
+    return Image.open(sio.StringIO(data))
+
+USER_DATA = None
+
+if platform.system() == 'Windows':
+    USER_DATA = os.path.join(os.getenv('APPDATA'), 'SoCo-Tk')
+elif platform.system() == 'Linux':
+    USER_DATA = '%(sep)shome%(sep)s%(name)s%(sep)s.config%(sep)sSoCo-Tk%(sep)s' % {
+    'sep' : os.sep,
+    'name': os.environ['LOGNAME']
+    }    
+##elif platform.system() == 'Mac':
+##    pass
+
+
+class WrappedSoCo(object):
+    # Stands in for soco.SoCo, speakers loaded from the database can be
+    # listed and selected before soco is imported
+    def __init__(self, ip, get_info = True):
+        self.speaker_ip = ip
+        self.speaker_info = {}
+        self.__speaker = None
+        if get_info: self.get_speaker_info()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        value = getattr(self.__getSpeaker(), name)
+        if TIMINGS.enabled and callable(value):
+            return self.__timedCall(value, 'speaker.' + name)
+
+        return value
+
+    def __timedCall(self, func, operation):
+        def timedCall(*args, **kwargs):
+            with TIMINGS.measure(operation, self.speaker_ip):
+                return func(*args, **kwargs)
+
+        return timedCall
+
+    def __getSpeaker(self):
+        if self.__speaker is None:
+            speaker = importSoCo().SoCo(self.speaker_ip)
+            speaker.speaker_info = self.speaker_info
+            self.__speaker = speaker
+
+        return self.__speaker
+
+    def get_speaker_info(self, refresh = False):
+        with TIMINGS.measure('speaker.get_speaker_info', self.speaker_ip):
+            self.__getSpeaker().get_speaker_info(refresh)
+
+        invalid_keys = [key for key, value in self.speaker_info.items() if value is None]
+        for key in invalid_keys:
+            del self.speaker_info[key]
+
+        return self.speaker_info
+        
+    def __str__(self):
+        name = self.speaker_info['zone_name']
+        if name is None:
+            name = 'Unnamed'
+        return name
+
+
+class PooledResponse(object):
+    # The parts of a requests response soco and we look at
+    def __init__(self, response, content):
+        self.status = self.status_code = response.status
+        self.reason = response.reason
+        self.content = self.text = content
+        self.__headers = response.msg
+
+    def getheader(self, name, default = None):
+        return self.__headers.getheader(name, default)
+
+
+# Upper bounds (ms) of the latency histogram buckets, the last bucket
+# takes everything slower
+TIMING_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class _NotTimed(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        return False
+
+_NOT_TIMED = _NotTimed()
+
+class _Timer(object):
+    def __init__(self, timings, operation, speaker):
+        self.timings = timings
+        self.operation = operation
+        self.speaker = speaker
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.timings.record(self.operation,
+                            time.time() - self.started,
+                            self.speaker,
+                            excType is not None)
+        return False
+
+
+# Latency histograms and error counts per operation (speaker calls, HTTP
+# requests, database and image work) and per speaker. Off by default,
+# measure() then hands out a shared do-nothing context, so a timed call
+# costs one attribute lookup
+class Timings(object):
+    def __init__(self):
+        self.enabled = False
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__operations = {}
+            self.__speakers = {}
+            self.__since = time.time()
+
+    def measure(self, operation, speaker = None):
+        if not self.enabled:
+            return _NOT_TIMED
+
+        return _Timer(self, operation, speaker)
+
+    def record(self, operation, elapsed, speaker = None, failed = False):
+        elapsed *= 1000
+        bucket = bisect.bisect_left(TIMING_BUCKETS, elapsed)
+
+        with self.__lock:
+            entries = [self.__operations.setdefault(operation, self.__newEntry())]
+            if speaker is not None:
+                entries.append(self.__speakers.setdefault(speaker, {}).setdefault(operation, self.__newEntry()))
+
+            for entry in entries:
+                entry['count'] += 1
+                entry['total'] += elapsed
+                entry['max'] = max(entry['max'], elapsed)
+                entry['histogram'][bucket] += 1
+                if failed:
+                    entry['errors'] += 1
+
+    def getStats(self):
+        with self.__lock:
+            operations = dict((operation, self.__summarize(entry))
+                              for operation, entry in self.__operations.items())
+            speakers = dict((speaker, dict((operation, self.__summarize(entry))
+                                           for operation, entry in entries.items()))
+                            for speaker, entries in self.__speakers.items())
+            since = self.__since
+
+        return {
+            'enabled': self.enabled,
+            'since': since,
+            'duration': time.time() - since,
+            'buckets_ms': list(TIMING_BUCKETS),
+            'operations': operations,
+            'speakers': speakers,
+            }
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.getStats(), f, indent = 2, sort_keys = True)
+
+    def __newEntry(self):
+        return {
+            'count': 0,
+            'errors': 0,
+            'total': 0.0,
+            'max': 0.0,
+            'histogram': [0] * (len(TIMING_BUCKETS) + 1),
+            }
+
+    def __summarize(self, entry):
+        count = entry['count']
+        return {
+            'count': count,
+            'errors': entry['errors'],
+            'mean_ms': entry['total'] / count if count else 0.0,
+            'max_ms': entry['max'],
+            'p50_ms': self.__percentile(entry, 0.5),
+            'p95_ms': self.__percentile(entry, 0.95),
+            'histogram': list(entry['histogram']),
+            }
+
+    def __percentile(self, entry, fraction):
+        # Upper bound of the bucket holding the percentile, the slowest
+        # bucket has none and reports the maximum instead
+        wanted = entry['count'] * fraction
+        seen = 0
+        for index, count in enumerate(entry['histogram']):
+            seen += count
+            if count and seen >= wanted:
+                if index < len(TIMING_BUCKETS):
+                    return min(float(TIMING_BUCKETS[index]), entry['max'])
+                return entry['max']
+
+        return 0.0
+
+
+TIMINGS = Timings()
+
+def timed(operation):
+    # Method decorator, times every call as operation
+    def decorate(func):
+        def timedFunc(*args, **kwargs):
+            if not TIMINGS.enabled:
+                return func(*args, **kwargs)
+
+            with TIMINGS.measure(operation):
+                return func(*args, **kwargs)
+
+        timedFunc.__name__ = func.__name__
+        timedFunc.__doc__ = func.__doc__
+        return timedFunc
+
+    return decorate
+
+
+# Keeps HTTP/1.1 connections open between requests so talking to a speaker
+# does not start with a new TCP handshake every time. SOAP calls (through
+# soco), album art and event subscriptions all share one pool. Each host
+# gets at most maxPerHost connections at once, connections idle for longer
+# than idleTimeout are closed instead of reused
+class ConnectionPool(object):
+    def __init__(self, maxPerHost = 4, idleTimeout = 20, requestTimeout = 10):
+        self.maxPerHost = maxPerHost
+        self.idleTimeout = idleTimeout
+        self.requestTimeout = requestTimeout
+
+        self.__lock = threading.Lock()
+        self.__idle = {}
+        self.__slots = {}
+        self.__stats = dict.fromkeys(('requests', 'created', 'reused', 'expired', 'retried', 'failed'), 0)
+
+    def request(self, method, url, body = None, headers = None, timeout = None):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Unsupported url: %s' % url)
+
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        with TIMINGS.measure('http.' + method, parts.hostname):
+            return self.__request(key, method, path, body, headers, timeout)
+
+    def __request(self, key, method, path, body, headers, timeout):
+        slot = self.__getSlot(key)
+        slot.acquire()
+        try:
+            self.__count('requests')
+            fresh = False
+            while True:
+                connection, reused = self.__checkout(key, timeout, fresh)
+                sent = False
+                try:
+                    connection.request(method, path, body, headers or {})
+                    sent = True
+                    response = connection.getresponse()
+                    content = response.read()
+                except (httplib.HTTPException, socket.error), e:
+                    connection.close()
+
+                    # The speaker may have dropped a connection we kept
+                    # open. Only if that means it never got the request
+                    # is it sent again, once and on a new connection: a
+                    # Next that timed out must not skip a second track
+                    if reused and _neverArrived(e, sent):
+                        self.__count('retried')
+                        fresh = True
+                        continue
+
+                    self.__count('failed')
+                    raise
+
+                if response.will_close:
+                    connection.close()
+                else:
+                    self.__checkin(key, connection)
+
+                return PooledResponse(response, content)
+        finally:
+            slot.release()
+
+    def fetch(self, url, redirects = 3):
+        # GET that follows redirects and fails on anything but 200
+        for i in xrange(redirects + 1):
+            response = self.request('GET', url)
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+
+            if response.status != 200:
+                raise IOError('GET %s failed: %d %s' % (url, response.status, response.reason))
+
+            return response.content
+
+        raise IOError('GET %s: too many redirects' % url)
+
+    def closeIdle(self):
+        with self.__lock:
+            idle = self.__idle
+            self.__idle = {}
+
+        for connections in idle.values():
+            for connection, lastUsed in connections:
+                connection.close()
+
+    def getStats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['idle'] = sum(len(connections) for connections in self.__idle.values())
+
+        stats['reuse_rate'] = float(stats['reused']) / stats['requests'] if stats['requests'] else 0.0
+        return stats
+
+    def __count(self, name):
+        with self.__lock:
+            self.__stats[name] += 1
+
+    def __getSlot(self, key):
+        with self.__lock:
+            slot = self.__slots.get(key)
+            if slot is None:
+                slot = self.__slots[key] = threading.Semaphore(self.maxPerHost)
+
+            return slot
+
+    def __checkout(self, key, timeout, fresh = False):
+        timeout = timeout or self.requestTimeout
+        now = time.time()
+
+        with self.__lock:
+            connections = self.__idle.get(key, [])
+            while connections and not fresh:
+                connection, lastUsed = connections.pop()
+                if now - lastUsed > self.idleTimeout:
+                    self.__stats['expired'] += 1
+                    connection.close()
+                    continue
+
+                self.__stats['reused'] += 1
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+
+            self.__stats['created'] += 1
+
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout = timeout), False
+
+        return httplib.HTTPConnection(host, port, timeout = timeout), False
+
+    def __checkin(self, key, connection):
+        with self.__lock:
+            self.__idle.setdefault(key, []).append((connection, time.time()))
+
+
+def _neverArrived(error, sent):
+    # True if error proves the server did not get the request: the
+    # connection turned out closed while sending, or was closed before a
+    # single byte of the response. A timeout proves nothing
+    if isinstance(error, socket.timeout):
+        return False
+
+    if not sent:
+        return isinstance(error, socket.error) and\
+               error.errno in (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
+    # Older Pythons pass the empty line itself, newer ones a message
+    return isinstance(error, httplib.BadStatusLine) and\
+           (error.line in ('', "''") or error.line.startswith('No status line'))
+
+
+# soco talks to the speakers through requests.get and requests.post, this
+# gives it the same two calls on top of our pool. Only the arguments the
+# pool supports are accepted, anything else is a TypeError
+class PooledRequests(object):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def get(self, url, headers = None, timeout = None):
+        return self.pool.request('GET', url, headers = headers, timeout = self.__timeout(timeout))
+
+    def post(self, url, data = None, headers = None, timeout = None):
+        return self.pool.request('POST', url, data, headers, self.__timeout(timeout))
+
+    def __timeout(self, timeout):
+        # A (connect, read) pair as requests takes it, one socket timeout
+        # has to cover both
+        if isinstance(timeout, tuple):
+            return max(timeout)
+        return timeout
+
+
+HTTP_POOL = ConnectionPool()
+
+
+class Task(object):
+    def __init__(self, func, args = (), kwargs = None, callback = None, errback = None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.callback = callback
+        self.errback = errback
+
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.done = None
+        self.queued = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        if not self.cancelled:
+            try:
+                self.result = self.func(*self.args, **self.kwargs)
+            except:
+                self.error = traceback.format_exc()
+
+        if self.done: self.done(self)
+
+    def deliver(self):
+        if self.cancelled:
+            return
+
+        if self.error is not None:
+            if self.errback:
+                self.errback(self.error)
+            else:
+                logging.error('Background call %s failed', self.func)
+                logging.error(self.error)
+            return
+
+        if self.callback: self.callback(self.result)
+
+
+class WorkerPool(object):
+    def __init__(self, size = 4, name = 'SoCoWorker'):
+        self.__tasks = Queue.Queue()
+        self.__threads = []
+
+        for index in range(size):
+            thread = threading.Thread(target = self.__work,
+                                      name = '%s-%d' % (name, index))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def submit(self, task):
+        self.__tasks.put(task)
+        return task
+
+    def shutdown(self, timeout = None):
+        # With a timeout, waits for the tasks submitted before to finish
+        for thread in self.__threads:
+            self.__tasks.put(None)
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+            for thread in self.__threads:
+                thread.join(max(deadline - time.time(), 0))
+                if thread.is_alive():
+                    logging.error('Workers did not finish within %d s', timeout)
+                    break
+        del self.__threads[:]
+
+    def __work(self):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                break
+
+            task.run()
+
+
+EVENT_SERVICES = {
+    'transport':    '/MediaRenderer/AVTransport/Event',
+    'rendering':    '/MediaRenderer/RenderingControl/Event',
+    'queue':        '/MediaRenderer/Queue/Event',
+    'content':      '/MediaServer/ContentDirectory/Event',
+    }
+
+NS_DIDL = '{urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/}'
+NS_DC = '{http://purl.org/dc/elements/1.1/}'
+NS_UPNP = '{urn:schemas-upnp-org:metadata-1-0/upnp/}'
+
+
+def parseEvent(service, body, speaker_ip):
+    # Turns the body of a NOTIFY into the changes we care about:
+    # 'volume', 'track' (same keys as get_current_track_info) and 'queue'
+    changes = {}
+
+    dom = XML.fromstring(body)
+    for prop in dom.findall('.//{urn:schemas-upnp-org:event-1-0}property'):
+        for variable in prop:
+            name = variable.tag.split('}')[-1]
+            value = variable.text or ''
+
+            if name == 'ContainerUpdateIDs':
+                if any(part.startswith('Q:') for part in value.split(',')):
+                    changes['queue'] = True
+                continue
+
+            if name != 'LastChange' or not value:
+                continue
+
+            lastChange = XML.fromstring(value.encode('utf-8'))
+            for element in lastChange.iter():
+                tag = element.tag.split('}')[-1]
+                val = element.get('val')
+
+                if service == 'rendering' and tag == 'Volume' and\
+                   element.get('channel') == 'Master':
+                    changes['volume'] = int(val)
+                elif service == 'queue' and tag == 'UpdateID':
+                    changes['queue'] = True
+                elif service == 'transport' and tag == 'CurrentTrackURI':
+                    changes.setdefault('track', {})['uri'] = val
+                elif service == 'transport' and tag == 'CurrentTrackMetaData':
+                    changes.setdefault('track', {}).update(parseTrackMetaData(val, speaker_ip))
+
+    return changes
+
+def parseTrackMetaData(metadata, speaker_ip):
+    track = {
+        'title': '',
+        'artist': '',
+        'album': '',
+        'album_art': '',
+        }
+
+    if not metadata or metadata == 'NOT_IMPLEMENTED':
+        return track
+
+    dom = XML.fromstring(metadata.encode('utf-8'))
+    item = dom.find(NS_DIDL + 'item')
+    if item is None:
+        return track
+
+    track['title'] = item.findtext(NS_DC + 'title') or ''
+    track['artist'] = item.findtext(NS_DC + 'creator') or ''
+    track['album'] = item.findtext(NS_UPNP + 'album') or ''
+
+    album_art = item.findtext(NS_UPNP + 'albumArtURI')
+    if album_art:
+        if album_art.startswith('/'):
+            album_art = 'http://' + speaker_ip + ':1400' + album_art
+        track['album_art'] = album_art
+
+    return track
+
+BROWSE_QUEUE_ACTION = '"urn:schemas-upnp-org:service:ContentDirectory:1#Browse"'
+BROWSE_QUEUE_BODY = '<?xml version="1.0"?>'\
+                    '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '\
+                    's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'\
+                    '<u:Browse xmlns:u="urn:schemas-upnp-org:service:ContentDirectory:1">'\
+                    '<ObjectID>Q:0</ObjectID>'\
+                    '<BrowseFlag>BrowseDirectChildren</BrowseFlag>'\
+                    '<Filter>dc:title,res,dc:creator,upnp:artist,upnp:album,upnp:albumArtURI</Filter>'\
+                    '<StartingIndex>%d</StartingIndex>'\
+                    '<RequestedCount>%d</RequestedCount>'\
+                    '<SortCriteria></SortCriteria>'\
+                    '</u:Browse></s:Body></s:Envelope>'
+
+def parseBrowseResult(body, speaker_ip):
+    # The items of a queue page (QueueItems, album art made absolute),
+    # the size of the queue and its UpdateID, which the speaker changes
+    # whenever the queue changes
+    dom = XML.fromstring(body)
+    total = int(dom.findtext('.//TotalMatches') or 0)
+    updateId = dom.findtext('.//UpdateID')
+
+    items = []
+    result = dom.findtext('.//Result')
+    if result:
+        for element in XML.fromstring(result.encode('utf-8')).findall(NS_DIDL + 'item'):
+            album_art = element.findtext(NS_UPNP + 'albumArtURI')
+            if album_art and album_art.startswith('/'):
+                album_art = 'http://' + speaker_ip + ':1400' + album_art
+
+            items.append(QueueItem(element.findtext(NS_DC + 'title'),
+                                   element.findtext(NS_DC + 'creator'),
+                                   element.findtext(NS_UPNP + 'album'),
+                                   album_art,
+                                   element.findtext(NS_DIDL + 'res')))
+
+    return items, total, int(updateId) if updateId else None
+
+
+class _NotifyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_NOTIFY(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length)
+
+        self.send_response(200)
+        self.end_headers()
+
+        self.server.listener.notify(self.path.split('/')[-1],
+                                    self.headers.getheader('sid'),
+                                    self.headers.getheader('seq'),
+                                    body)
+
+    def log_message(self, format, *args):
+        logging.debug('Event listener: ' + format, *args)
+
+
+class _NotifyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+# Receives UPnP event notifications from the speakers on a small local
+# HTTP server and manages the subscriptions pointing at it. Every call
+# talking to a speaker blocks and is meant to run on a worker thread
+class EventListener(object):
+    def __init__(self, onEvent, port = 0):
+        self.onEvent = onEvent
+        self.port = port
+        self.timeout = 1800
+        self.requestTimeout = 5
+
+        self.__server = None
+        self.__thread = None
+        self.__speakers = {}
+
+    def start(self):
+        if self.__server is not None:
+            return
+
+        self.__server = _NotifyServer(('', self.port), _NotifyHandler)
+        self.__server.listener = self
+        self.port = self.__server.server_address[1]
+
+        self.__thread = threading.Thread(target = self.__server.serve_forever,
+                                         name = 'SoCoEvents')
+        self.__thread.daemon = True
+        self.__thread.start()
+        logging.info('Listening for speaker events on port %d', self.port)
+
+    def stop(self):
+        if self.__server is None:
+            return
+
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__server = None
+        self.__thread = None
+
+    def notify(self, service, sid, seq, body):
+        # Called on the listener thread
+        speaker_ip = self.__speakers.get(sid)
+        if speaker_ip is None:
+            logging.debug('Event for unknown subscription %s, skipping', sid)
+            return
+
+        try:
+            changes = parseEvent(service, body, speaker_ip)
+        except:
+            logging.error('Could not parse %s event', service)
+            logging.error(traceback.format_exc())
+            return
+
+        if changes:
+            self.onEvent(sid, service, seq, changes)
+
+    def subscribe(self, speaker_ip, service):
+        headers = {
+            'CALLBACK': '<http://%s:%d/notify/%s>' % (self.__localAddress(speaker_ip), self.port, service),
+            'NT': 'upnp:event',
+            'TIMEOUT': 'Second-%d' % self.timeout,
+            }
+        response = self.__request(speaker_ip, 'SUBSCRIBE', EVENT_SERVICES[service], headers)
+
+        sid = response.getheader('sid')
+        self.__speakers[sid] = speaker_ip
+        return sid, self.__getTimeout(response)
+
+    def renew(self, speaker_ip, service, sid):
+        headers = {
+            'SID': sid,
+            'TIMEOUT': 'Second-%d' % self.timeout,
+            }
+        response = self.__request(speaker_ip, 'SUBSCRIBE', EVENT_SERVICES[service], headers)
+        return self.__getTimeout(response)
+
+    def unsubscribe(self, speaker_ip, service, sid):
+        self.__speakers.pop(sid, None)
+        self.__request(speaker_ip, 'UNSUBSCRIBE', EVENT_SERVICES[service], {'SID': sid})
+
+    def __request(self, speaker_ip, method, path, headers):
+        response = HTTP_POOL.request(method,
+                                     'http://%s:1400%s' % (speaker_ip, path),
+                                     headers = headers,
+                                     timeout = self.requestTimeout)
+
+        if response.status != 200:
+            raise IOError('%s %s failed: %d %s' % (method, path, response.status, response.reason))
+
+        return response
+
+    def __getTimeout(self, response):
+        timeout = response.getheader('timeout') or ''
+        if timeout.lower().startswith('second-'):
+            try:
+                return int(timeout[7:])
+            except ValueError:
+                pass
+
+        return self.timeout
+
+    def __localAddress(self, speaker_ip):
+        # The address the speaker can reach us on is the one our
+        # traffic towards it leaves from
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect((speaker_ip, 1400))
+            return sock.getsockname()[0]
+        finally:
+            sock.close()
+
+
+# Owns the only connection that writes to the settings database. Writes
+# are queued from the Tk thread and run on a background thread, which
+# groups whatever arrives within batchDelay into a single commit
+class DatabaseWriter(object):
+    def __init__(self, dbPath, batchDelay = 0.5, batchSize = 500):
+        self.batchDelay = batchDelay
+        self.batchSize = batchSize
+
+        self.__dbPath = dbPath
+        self.__queue = Queue.Queue()
+        self.__thread = threading.Thread(target = self.__run,
+                                         name = 'SoCoWriter')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def execute(self, sql, params = ()):
+        self.__queue.put(('execute', (sql, params)))
+
+    def executemany(self, sql, seq_of_params):
+        self.__queue.put(('executemany', (sql, list(seq_of_params))))
+
+    def transaction(self, statements):
+        # Statements given together end up in the same commit, or none of
+        # them does when one fails
+        self.__queue.put(('transaction', list(statements)))
+
+    def flush(self, timeout = 10):
+        done = threading.Event()
+        self.__queue.put(('flush', done))
+        if not done.wait(timeout):
+            logging.error('Database writer did not flush within %d s', timeout)
+            return False
+        return True
+
+    def close(self, timeout = 10):
+        if self.__thread is None:
+            return
+
+        self.__queue.put(('stop', None))
+        self.__thread.join(timeout)
+        self.__thread = None
+
+    def __run(self):
+        # Transactions are begun and committed here, a savepoint keeps a
+        # failed transaction from taking the rest of the batch with it
+        connection = sql.connect(self.__dbPath, timeout = 30, isolation_level = None)
+        connection.execute('PRAGMA journal_mode = WAL').close()
+        connection.execute('PRAGMA synchronous = NORMAL').close()
+
+        running = True
+        while running:
+            batch = [self.__queue.get()]
+            deadline = time.time() + self.batchDelay
+
+            while len(batch) < self.batchSize and batch[-1][0] not in ('flush', 'stop'):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                try:
+                    batch.append(self.__queue.get(timeout = remaining))
+                except Queue.Empty:
+                    break
+
+            waiting = []
+            failed = False
+            started = time.time()
+            connection.execute('BEGIN').close()
+            for kind, payload in batch:
+                if kind == 'flush':
+                    waiting.append(payload)
+                    continue
+                elif kind == 'stop':
+                    running = False
+                    continue
+
+                try:
+                    if kind == 'execute':
+                        connection.execute(*payload).close()
+                    elif kind == 'executemany':
+                        connection.executemany(*payload).close()
+                    elif kind == 'transaction':
+                        self.__transaction(connection, payload)
+                except:
+                    failed = True
+                    logging.error('Could not write to database')
+                    logging.error(traceback.format_exc())
+
+            try:
+                connection.execute('COMMIT').close()
+            except:
+                failed = True
+                logging.error('Could not commit to database')
+                logging.error(traceback.format_exc())
+
+                # The batch is lost, the next one starts a new transaction
+                try:
+                    connection.execute('ROLLBACK').close()
+                except sql.Error:
+                    pass
+
+            if TIMINGS.enabled and len(waiting) < len(batch):
+                TIMINGS.record('db.commit', time.time() - started, failed = failed)
+
+            for done in waiting:
+                done.set()
+
+        connection.close()
+        logging.info('Database writer stopped')
+
+    def __transaction(self, connection, statements):
+        connection.execute('SAVEPOINT batch_transaction').close()
+        try:
+            for statement in statements:
+                connection.execute(*statement).close()
+        except:
+            connection.execute('ROLLBACK TO batch_transaction').close()
+            raise
+        finally:
+            connection.execute('RELEASE batch_transaction').close()
+
+
+# Album art is stored once per content hash. Art urls (and album keys)
+# point at a hash through art_sources, tracks through track_art, so a
+# cover shared by a whole album is downloaded and stored only once.
+class AlbumArtCache(object):
+    def __init__(self, connection, writer, store_originals = False, max_bytes = 50 * 1024 * 1024, max_rows = 2000):
+        self._connection = connection
+        self._writer = writer
+        self.store_originals = store_originals
+        self.thumbnail_format = 'JPEG'
+        self.thumbnail_quality = 85
+
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+
+        self.hits = 0
+        self.misses = 0
+        self.__touched = {}
+
+    def touch(self, art_hash):
+        # Access times are only collected here and written by compact(),
+        # a cache hit never has to write to the database
+        self.hits += 1
+        self.__touched[art_hash] = time.time()
+
+    def recordMiss(self):
+        self.misses += 1
+
+    def hashArt(self, raw_data):
+        return hashlib.sha1(raw_data).hexdigest()
+
+    @timed('db.findTrackHash')
+    def findTrackHash(self, track_uri):
+        __sql = 'SELECT hash FROM track_art WHERE uri = ? LIMIT 1'
+        with clib.closing(self._connection.execute(__sql, (track_uri,))) as cur:
+            row = cur.fetchone()
+            if row:
+                return row['hash']
+
+        return None
+
+    @timed('db.findSourceHash')
+    def findSourceHash(self, sources):
+        __sql = 'SELECT hash FROM art_sources WHERE source = ? LIMIT 1'
+        for source in sources:
+            if not source:
+                continue
+
+            with clib.closing(self._connection.execute(__sql, (source,))) as cur:
+                row = cur.fetchone()
+                if row:
+                    return row['hash']
+
+        return None
+
+    @timed('db.getThumbnail')
+    def getThumbnail(self, art_hash, size):
+        __sql = '''
+            SELECT image FROM thumbnails AS t
+            WHERE
+                t.hash = ? AND
+                t.width = ? AND
+                t.height = ?
+            LIMIT 1
+        '''
+        with clib.closing(self._connection.execute(__sql, (art_hash,) + tuple(size))) as cur:
+            row = cur.fetchone()
+            if row:
+                return str(row['image'])
+
+        return None
+
+    @timed('db.getOriginal')
+    def getOriginal(self, art_hash):
+        __sql = '''
+            SELECT image FROM art AS a
+            WHERE
+                a.hash = ? AND
+                a.image IS NOT NULL
+            LIMIT 1
+        '''
+        with clib.closing(self._connection.execute(__sql, (art_hash,))) as cur:
+            row = cur.fetchone()
+            if row:
+                return str(row['image'])
+
+        return None
+
+    @timed('image.thumbnail')
+    def makeThumbnail(self, raw_data, size):
+        image = openImage(raw_data)
+
+        # Lets the JPEG decoder scale down by up to 8 while decoding (never
+        # below size), a 1000px cover is not decoded in full for a small
+        # thumbnail. thumbnail() asks for the same, this keeps it explicit
+        image.draft('RGB', size)
+
+        logging.debug('Resizing album art to: %s', size)
+        image.thumbnail(size, Image.ANTIALIAS)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        output = sio.StringIO()
+        image.save(output,
+                   self.thumbnail_format,
+                   quality = self.thumbnail_quality,
+                   optimize = True)
+
+        return image, output.getvalue()
+
+    def store(self, art_hash, size, thumbnail, original = None):
+        statements = []
+
+        __sql = '''
+            INSERT OR IGNORE INTO art (
+                hash,
+                image,
+                last_access
+            ) VALUES (?, NULL, ?)
+        '''
+        statements.append((__sql, (art_hash, time.time())))
+
+        if original is not None and self.store_originals:
+            __sql = 'UPDATE art SET image = ? WHERE hash = ?'
+            logging.info('Storing original album art: %s', art_hash)
+            statements.append((__sql, (buffer(original), art_hash)))
+
+        __sql = '''
+            INSERT OR REPLACE INTO thumbnails (
+                hash,
+                width,
+                height,
+                image
+            ) VALUES (?, ?, ?, ?)
+        '''
+        logging.info('Storing album art thumbnail %s: %s', size, art_hash)
+        statements.append((__sql, (art_hash,) + tuple(size) + (buffer(thumbnail),)))
+
+        self._writer.transaction(statements)
+
+    def link(self, art_hash, track_uri = None, sources = ()):
+        statements = []
+
+        if track_uri:
+            __sql = 'INSERT OR REPLACE INTO track_art (uri, hash) VALUES (?, ?)'
+            statements.append((__sql, (track_uri, art_hash)))
+
+        __sql = 'INSERT OR REPLACE INTO art_sources (source, hash) VALUES (?, ?)'
+        for source in sources:
+            if not source:
+                continue
+            statements.append((__sql, (source, art_hash)))
+
+        self._writer.transaction(statements)
+
+    def getStats(self):
+        __sql = '''
+            SELECT
+                (SELECT COUNT(*) FROM art) AS art,
+                (SELECT COUNT(*) FROM thumbnails) AS thumbnails,
+                (SELECT COALESCE(SUM(LENGTH(image)), 0) FROM art) +
+                (SELECT COALESCE(SUM(LENGTH(image)), 0) FROM thumbnails) AS size
+        '''
+        with clib.closing(self._connection.execute(__sql)) as cur:
+            row = cur.fetchone()
+            stats = {
+                'art': row['art'],
+                'thumbnails': row['thumbnails'],
+                'size': row['size'],
+                }
+
+        lookups = self.hits + self.misses
+        stats['hits'] = self.hits
+        stats['misses'] = self.misses
+        stats['hit_rate'] = float(self.hits) / lookups if lookups else 0.0
+        return stats
+
+    def takeTouched(self):
+        touched = self.__touched
+        self.__touched = {}
+        return touched
+
+    @timed('db.compact')
+    def compact(self, dbPath, touched):
+        # Runs on a worker thread with its own connection: stores the
+        # collected access times, evicts least recently used art until
+        # the cache fits its budget and hands free pages back to the OS
+        connection = sql.connect(dbPath, timeout = 30)
+        try:
+            connection.executemany('UPDATE art SET last_access = ? WHERE hash = ?',
+                                   [(accessed, art_hash) for art_hash, accessed in touched.items()])
+            connection.commit()
+
+            __sql = '''
+                SELECT
+                    a.hash,
+                    COALESCE(LENGTH(a.image), 0) +
+                    COALESCE((SELECT SUM(LENGTH(t.image)) FROM thumbnails AS t WHERE t.hash = a.hash), 0)
+                FROM art AS a
+                ORDER BY a.last_access DESC
+            '''
+            evict = []
+            totalSize = 0
+            with clib.closing(connection.execute(__sql)) as cur:
+                for index, (art_hash, size) in enumerate(cur):
+                    totalSize += size
+                    if index >= self.max_rows or totalSize > self.max_bytes:
+                        evict.append((art_hash,))
+
+            if evict:
+                logging.info('Evicting %d album art entries', len(evict))
+                for table in ('thumbnails', 'track_art', 'art_sources', 'art'):
+                    connection.executemany('DELETE FROM %s WHERE hash = ?' % table, evict)
+                connection.commit()
+
+            with clib.closing(connection.execute('PRAGMA auto_vacuum')) as cur:
+                autoVacuum = cur.fetchone()[0]
+
+            if autoVacuum != 2:
+                # Switching an existing database to incremental mode
+                # needs one full vacuum, later runs are incremental
+                logging.info('Enabling incremental vacuum')
+                connection.execute('PRAGMA auto_vacuum = INCREMENTAL').close()
+                connection.execute('VACUUM').close()
+            else:
+                connection.execute('PRAGMA incremental_vacuum').close()
+                connection.commit()
+
+            return len(evict)
+        finally:
+            connection.close()
+
+
+def diffQueue(old, new):
+    # Compares two lists of queue uris. Returns the edits turning old
+    # into new as (index, count, newStart, newEnd) tuples, last edit
+    # first so every index is still valid when its edit is applied,
+    # and a function mapping an old index to its new one (or None)
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk = False)
+    opcodes = matcher.get_opcodes()
+
+    edits = []
+    equal = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            equal.append((i1, i2, j1))
+        else:
+            edits.append((i1, i2 - i1, j1, j2))
+    edits.reverse()
+
+    starts = [block[0] for block in equal]
+    def mapIndex(index):
+        position = bisect.bisect_right(starts, index) - 1
+        if position < 0:
+            return None
+
+        i1, i2, j1 = equal[position]
+        if index >= i2:
+            return None
+
+        return j1 + index - i1
+
+    return edits, mapIndex
+
+def applyQueueDiff(items, new, edits):
+    for index, count, newStart, newEnd in edits:
+        items[index:index + count] = new[newStart:newEnd]
+
+
+# One queue entry. Reads like the dict soco returns (item['title'],
+# item.get('album_art'), '%(artist)s' % item) without carrying a dict
+# per track
+class QueueItem(object):
+    __slots__ = ('title', 'artist', 'album', 'album_art', 'uri')
+
+    def __init__(self, title = None, artist = None, album = None, album_art = None, uri = None):
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.album_art = album_art
+        self.uri = uri
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default = None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def __repr__(self):
+        return 'QueueItem(%r)' % self.uri
+
+
+SEARCH_WORDS = re.compile(r'\w+', re.UNICODE)
+
+# The items of a queue with one copy of every artist and album string and
+# the position of every uri, looking up the playing track does not have
+# to walk the queue. Indexing, len() and iteration work like on a list.
+# search() matches words of title, artist and album by prefix through an
+# index of every word, built on the first search and then kept up to date
+# as items are added
+class QueueContent(object):
+    def __init__(self, items = ()):
+        self.__items = []
+        self.__strings = {}
+        self.__positions = {}
+        self.__indexed = 0
+        self.__words = {}
+        self.__sortedWords = None
+        self.__searchIndexed = 0
+        self.__itemPositions = None
+        self.extend(items)
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __getitem__(self, index):
+        return self.__items[index]
+
+    def __iter__(self):
+        return iter(self.__items)
+
+    def __nonzero__(self):
+        return bool(self.__items)
+
+    def extend(self, items):
+        self.__items.extend(self.__compact(item) for item in items)
+
+    def clear(self):
+        del self.__items[:]
+        self.__strings.clear()
+        self.__resetIndexes()
+
+    def applyDiff(self, new, edits):
+        # The search index (if there is one) is only updated for the items
+        # removed and inserted, a refresh rarely changes many
+        items = self.__items
+        new = list(new)
+        for index, count, newStart, newEnd in edits:
+            new[newStart:newEnd] = [self.__compact(item) for item in new[newStart:newEnd]]
+
+        searchIndexed = self.__searchIndexed > 0
+        if searchIndexed:
+            self.buildSearchIndex()
+            removed = [item for index, count, newStart, newEnd in edits
+                       for item in items[index:index + count]]
+
+        applyQueueDiff(items, new, edits)
+        self.__positions.clear()
+        self.__indexed = 0
+        self.__itemPositions = None
+
+        if searchIndexed:
+            self.__unindex(removed)
+            self.__index([item for index, count, newStart, newEnd in edits
+                          for item in new[newStart:newEnd]])
+            self.__searchIndexed = len(items)
+
+    def uris(self):
+        return [item.uri for item in self.__items]
+
+    def indexOf(self, uri):
+        # First position of uri or None. Positions are collected as far
+        # as items were added and all over again after an edit
+        items = self.__items
+        if self.__indexed < len(items):
+            positions = self.__positions
+            for index in xrange(self.__indexed, len(items)):
+                positions.setdefault(items[index].uri, index)
+            self.__indexed = len(items)
+
+        return self.__positions.get(uri)
+
+    def search(self, text):
+        # Positions (ascending) of the items having a word starting with
+        # every word of text, None for a text without words
+        prefixes = set(word.lower() for word in SEARCH_WORDS.findall(text))
+        if not prefixes:
+            return None
+
+        self.buildSearchIndex()
+        words = self.__words
+        sortedWords = self.__sortedWords
+        if sortedWords is None:
+            sortedWords = self.__sortedWords = sorted(words)
+
+        matches = None
+        # Longer prefixes match fewer words, starting with them keeps
+        # the sets small
+        for prefix in sorted(prefixes, key = len, reverse = True):
+            found = set()
+            index = bisect.bisect_left(sortedWords, prefix)
+            while index < len(sortedWords) and sortedWords[index].startswith(prefix):
+                found.update(words[sortedWords[index]])
+                index += 1
+
+            matches = found if matches is None else matches & found
+            if not matches:
+                return []
+
+        itemPositions = self.__itemPositions
+        if itemPositions is None:
+            itemPositions = self.__itemPositions = dict(itertools.izip(self.__items, itertools.count()))
+
+        return sorted(itemPositions[item] for item in matches)
+
+    def buildSearchIndex(self):
+        # Indexes the items added since the last call, search() does this
+        # itself but a big queue is better indexed before the first letter
+        items = self.__items
+        if self.__searchIndexed >= len(items):
+            return
+
+        added = items[self.__searchIndexed:]
+        if self.__itemPositions is not None:
+            self.__itemPositions.update(itertools.izip(added, itertools.count(self.__searchIndexed)))
+
+        self.__index(added)
+        self.__searchIndexed = len(items)
+        if self.__sortedWords is None:
+            self.__sortedWords = sorted(self.__words)
+
+    def __index(self, items):
+        # Words point at the items themselves rather than their positions,
+        # an edit does not move anything in the index
+        words = self.__words
+        newWords = []
+        for item in items:
+            for word in self.__itemWords(item):
+                postings = words.get(word)
+                if postings is None:
+                    words[word] = [item]
+                    newWords.append(word)
+                else:
+                    postings.append(item)
+
+        sortedWords = self.__sortedWords
+        if sortedWords is not None and newWords:
+            if len(newWords) > 64:
+                self.__sortedWords = None
+            else:
+                for word in newWords:
+                    bisect.insort(sortedWords, word)
+
+    def __unindex(self, items):
+        if not items:
+            return
+
+        words = self.__words
+        sortedWords = self.__sortedWords
+        removed = set(items)
+        for word in set(word for item in items for word in self.__itemWords(item)):
+            postings = [item for item in words[word] if item not in removed]
+            if postings:
+                words[word] = postings
+                continue
+
+            del words[word]
+            if sortedWords is not None:
+                del sortedWords[bisect.bisect_left(sortedWords, word)]
+
+    def __itemWords(self, item):
+        found = set()
+        for field in (item.title, item.artist, item.album):
+            if field:
+                found.update(SEARCH_WORDS.findall(field.lower()))
+        return found
+
+    def __resetIndexes(self):
+        self.__positions.clear()
+        self.__indexed = 0
+        self.__words = {}
+        self.__sortedWords = None
+        self.__searchIndexed = 0
+        self.__itemPositions = None
+
+    def __compact(self, item):
+        if not isinstance(item, QueueItem):
+            item = QueueItem(item.get('title'),
+                             item.get('artist'),
+                             item.get('album'),
+                             item.get('album_art'),
+                             item.get('uri'))
+
+        strings = self.__strings
+        item.artist = strings.setdefault(item.artist, item.artist)
+        item.album = strings.setdefault(item.album, item.album)
+        return item
+
+
+# Methods touching the database have to be called on the thread that called
+# open(), the ones talking to speakers may run on any thread
+class SonosController(object):
+    def __init__(self):
+        self.dbPath = None
+        self._connection = None
+        self._writer = None
+        self.artCache = None
+
+        self.scanTimeout = 5.0
+        self.scanWorkers = 32
+
+        self.speakerMaxAge = 30 * 24 * 3600
+        self.speakerSeenResolution = 60 * 60
+        self.__knownSpeakers = None
+        self.__speakerStates = {}
+
+    def open(self, dbPath = None):
+        if dbPath is None:
+            dbPath = os.path.join(USER_DATA, 'SoCo-Tk.sqlite')
+
+        createStructure = False
+        if not os.path.exists(dbPath):
+            logging.info('Database "%s" not found, creating', dbPath)
+            createStructure = True
+
+            directory = os.path.dirname(dbPath)
+            if directory and not os.path.exists(directory):
+                logging.info('Creating directory structure')
+                os.makedirs(directory)
+
+        logging.info('Connecting: %s', dbPath)
+        self.dbPath = dbPath
+        self._connection = sql.connect(dbPath)
+        self._connection.row_factory = sql.Row
+
+        if createStructure:
+            self._createSettingsDB()
+
+        self._upgradeSettingsDB()
+
+        # WAL lets the writer commit in the background while we keep
+        # reading on this connection
+        self._connection.execute('PRAGMA journal_mode = WAL').close()
+        self._writer = DatabaseWriter(dbPath)
+
+        self.artCache = AlbumArtCache(self._connection,
+                                      self._writer,
+                                      store_originals = self.getConfig('store_original_art') == '1')
+
+        for settingName, target, attribute in (('art_cache_max_bytes', self.artCache, 'max_bytes'),
+                                               ('art_cache_max_rows', self.artCache, 'max_rows'),
+                                               ('http_max_per_host', HTTP_POOL, 'maxPerHost'),
+                                               ('http_idle_timeout', HTTP_POOL, 'idleTimeout')):
+            value = self.getConfig(settingName)
+            if value:
+                try:
+                    setattr(target, attribute, int(value))
+                except ValueError:
+                    logging.error('Invalid value for "%s": "%s"', settingName, value)
+
+        if self.getConfig('timings_enabled') == '1':
+            TIMINGS.enabled = True
+
+        maxAge = self.getConfig('speaker_max_age_days')
+        if maxAge:
+            try:
+                self.speakerMaxAge = float(maxAge) * 24 * 3600
+            except ValueError:
+                logging.error('Invalid value for "speaker_max_age_days": "%s"', maxAge)
+
+        self.loadSpeakerStates()
+
+    def flush(self):
+        if self._writer:
+            self._writer.flush()
+
+    def close(self):
+        logging.info('HTTP connections: %(requests)d request(s), %(created)d opened, %(reused)d reused',
+                     HTTP_POOL.getStats())
+        HTTP_POOL.closeIdle()
+
+        if self._writer:
+            logging.info('Flushing pending database writes')
+            self._writer.close()
+            self._writer = None
+
+        if self._connection:
+            logging.info('Closing database connection')
+            self._connection.close()
+            self._connection = None
+
+    @timed('discovery')
+    def discoverIps(self):
+        disc = None
+        try:
+            disc = importSoCo().SonosDiscovery()
+            return disc.get_speaker_ips()
+        finally:
+            if disc: del disc
+
+    def probeSpeaker(self, ip):
+        started = time.time()
+        speaker = WrappedSoCo(ip)
+        return speaker, time.time() - started
+
+    def discoverSpeakers(self):
+        ips = self.discoverIps()
+
+        speakers = []
+        for ip in ips:
+            speaker = WrappedSoCo(ip)
+            if not speaker.speaker_info:
+                logging.warning('Speaker %s does not have any info (probably a bridge), skipping...', ip)
+                continue
+
+            speakers.append(speaker)
+
+        logging.debug('Found %d speaker(s)', len(speakers))
+        if len(speakers) > 1:
+            logging.debug('Sorting speakers based on name')
+            speakers = sorted(speakers,
+                              cmp = lambda a,b: cmp(str(a), str(b)))
+
+        return speakers
+
+    def scan(self, timeout = None, workers = None):
+        # Probes every ip at once like the window does, but blocks until
+        # all of them answered or timeout passed
+        timeout = self.scanTimeout if timeout is None else timeout
+        ips = self.discoverIps()
+        logging.debug('Probing %d ip(s)', len(ips))
+
+        results = self.runAll(self.probeSpeaker, ips, workers or self.scanWorkers, timeout)
+
+        speakers = []
+        for ip, result, errmsg in results:
+            if errmsg is not None:
+                logging.error('Could not probe speaker %s', ip)
+                logging.error(errmsg)
+                continue
+
+            if result is None:
+                logging.warning('Speaker %s did not answer within %.1f s', ip, timeout)
+                continue
+
+            speaker, elapsed = result
+            logging.info('Probed %s in %.0f ms', ip, elapsed * 1000)
+            if not speaker.speaker_info:
+                logging.warning('Speaker %s does not have any info (probably a bridge), skipping...', ip)
+                continue
+
+            speakers.append(speaker)
+
+        return sorted(speakers, cmp = lambda a,b: cmp(str(a), str(b)))
+
+    def runAll(self, func, items, workers = 8, timeout = None):
+        # Calls func(item) for every item at once and returns
+        # (item, result, errmsg) in the order of items, result and errmsg
+        # are both None for the ones still running after timeout
+        results = Queue.Queue()
+        pool = WorkerPool(size = max(1, min(len(items), workers)), name = 'SoCoRunAll')
+
+        tasks = []
+        for item in items:
+            task = Task(func, (item,))
+            task.done = results.put
+            tasks.append(pool.submit(task))
+
+        deadline = time.time() + timeout if timeout is not None else None
+        waiting = len(tasks)
+        while waiting:
+            try:
+                if deadline is None:
+                    results.get()
+                else:
+                    results.get(timeout = max(0, deadline - time.time()))
+            except Queue.Empty:
+                break
+            waiting -= 1
+
+        pool.shutdown()
+        return [(item, task.result, task.error) for item, task in zip(items, tasks)]
+
+    def missingSpeakers(self, speakers, listed = ()):
+        # Known speakers that did not answer this scan stay around until
+        # they age out, a speaker that is briefly unreachable should not
+        # disappear
+        found = set(speaker.speaker_info.get('uid') for speaker in speakers)
+        found.update(speaker.speaker_info.get('uid') for speaker in listed)
+
+        missing = [known['speaker'] for uid, known in (self.__knownSpeakers or {}).items()
+                   if uid not in found]
+        if missing:
+            logging.info('Keeping %d speaker(s) that did not answer', len(missing))
+
+        return missing
+
+    def findSpeaker(self, speakers, name):
+        # Matches a uid, an ip or a zone name (ignoring case)
+        for speaker in speakers:
+            if name in (speaker.speaker_info.get('uid'), speaker.speaker_ip):
+                return speaker
+
+        for speaker in speakers:
+            if str(speaker).lower() == name.lower():
+                return speaker
+
+        return None
+
+    def getTrackInfo(self, speaker):
+        track = speaker.get_current_track_info()
+        track['volume'] = speaker.volume()
+        return track
+
+    def getAlbumKey(self, track):
+        # Sonos serves art per track uri, so the album is the only thing
+        # telling us two tracks share a cover before downloading it
+        if not track.get('album'):
+            return None
+
+        return 'album:%s\x00%s' % (track.get('artist') or '', track['album'])
+
+    def getQueue(self, speaker, start, count):
+        return self.browseQueue(speaker, start, count)[0]
+
+    def browseQueue(self, speaker, start, count):
+        # Returns (items, total, updateId)
+        with TIMINGS.measure('speaker.browse_queue', speaker.speaker_ip):
+            response = HTTP_POOL.request('POST',
+                                         'http://%s:1400/MediaServer/ContentDirectory/Control' % speaker.speaker_ip,
+                                         BROWSE_QUEUE_BODY % (start, count),
+                                         {'Content-Type': 'text/xml', 'SOAPACTION': BROWSE_QUEUE_ACTION})
+            if response.status != 200:
+                raise IOError('Browse failed: %d %s' % (response.status, response.reason))
+
+            return parseBrowseResult(response.content, speaker.speaker_ip)
+
+    def getQueueVersion(self, speaker):
+        # One item is the least a Browse can ask for (0 means all of
+        # them), enough to learn (updateId, total)
+        items, total, updateId = self.browseQueue(speaker, 0, 1)
+        return updateId, total
+
+    def fetchQueueChanges(self, speaker, oldUris, pageSize):
+        # updateId is None when the queue changed while it was fetched
+        count = max(len(oldUris), pageSize)
+
+        queue = []
+        complete = False
+        updateId = None
+        total = 0
+        while len(queue) < count:
+            page, total, pageUpdateId = self.browseQueue(speaker, len(queue), pageSize)
+            if not queue:
+                updateId = pageUpdateId
+            elif pageUpdateId != updateId:
+                updateId = None
+
+            queue.extend(page)
+            if not page or len(queue) >= total:
+                complete = True
+                break
+
+        edits, mapIndex = diffQueue(oldUris, [item['uri'] for item in queue])
+        return queue, complete, edits, mapIndex, updateId, total
+
+    def runCommand(self, speaker, command, *args):
+        return getattr(speaker, command)(*args)
+
+    @timed('db.findCachedArt')
+    def findCachedArt(self, track_uri, sources, thumbSize, original = False):
+        # Looks the cover of a track up in the art cache, by track uri and
+        # then by its sources (url, album key), which links the track to
+        # it for next time. Returns (art_hash, thumbnail, raw_data) with
+        # the stored thumbnail or, if asked for and there is none, the
+        # stored original that still needs resizing
+        artCache = self.artCache
+
+        art_hash = None
+        if track_uri:
+            art_hash = artCache.findTrackHash(track_uri)
+
+        if art_hash is None:
+            art_hash = artCache.findSourceHash(sources)
+            if art_hash is None:
+                return None, None, None
+
+            logging.debug('Album art for uri "%s" already stored as: %s', track_uri, art_hash)
+            artCache.link(art_hash, track_uri, sources)
+
+        thumbnail = artCache.getThumbnail(art_hash, thumbSize)
+        raw_data = None
+        if thumbnail is None and original:
+            raw_data = artCache.getOriginal(art_hash)
+
+        if thumbnail is not None or raw_data is not None:
+            artCache.touch(art_hash)
+
+        return art_hash, thumbnail, raw_data
+
+    def storeAlbumArt(self, result, thumbSize, track_uris, sources, storeOriginal = True):
+        # Stores what fetchAlbumArt() or decodeAlbumArt() returned and
+        # links the tracks and sources to it
+        raw_data, art_hash, image, thumbnail = result
+
+        self.artCache.store(art_hash,
+                            thumbSize,
+                            thumbnail,
+                            raw_data if storeOriginal else None)
+        for track_uri in track_uris or [None]:
+            self.artCache.link(art_hash, track_uri, sources)
+
+    def fetchAlbumArt(self, url, thumbSize):
+        return self.decodeAlbumArt(HTTP_POOL.fetch(url), thumbSize)
+
+    def decodeAlbumArt(self, raw_data, thumbSize):
+        # Decodes and resizes without touching the database, meant for a
+        # worker thread. The image comes back fully loaded, only turning
+        # it into a PhotoImage is left for the Tk thread
+        image, thumbnail = self.artCache.makeThumbnail(raw_data, thumbSize)
+        return raw_data, self.artCache.hashArt(raw_data), image, thumbnail
+
+    def compactArtCache(self, touched):
+        # Opens its own connection, meant for a worker thread
+        return self.artCache.compact(self.dbPath, touched)
+
+    @timed('db.loadQueueCache')
+    def loadQueueCache(self, speaker):
+        # The queue stored for speaker as {'update_id', 'total', 'items'}
+        # (a QueueContent), None if there is none. Decoding a big queue
+        # takes a while, this opens its own connection for a worker thread
+        uid = speaker.speaker_info.get('uid')
+        if uid is None:
+            return None
+
+        __sql = 'SELECT update_id, total, items FROM queue_cache WHERE uid = ?'
+        connection = sql.connect(self.dbPath, timeout = 30)
+        try:
+            with clib.closing(connection.execute(__sql, (uid,))) as cur:
+                row = cur.fetchone()
+        finally:
+            connection.close()
+
+        if row is None or row[0] is None:
+            return None
+
+        updateId, total, blob = row
+        items = QueueContent(QueueItem(*values) for values in
+                             json.loads(zlib.decompress(str(blob))))
+
+        return {
+            'update_id': updateId,
+            'total': total,
+            'items': items,
+            }
+
+    @timed('db.storeQueueCache')
+    def storeQueueCache(self, speaker, updateId, total, items):
+        # Items are stored as one compressed blob, a queue is always
+        # read and written as a whole
+        uid = speaker.speaker_info.get('uid')
+        if uid is None or updateId is None:
+            return
+
+        data = zlib.compress(json.dumps([(item.get('title'),
+                                          item.get('artist'),
+                                          item.get('album'),
+                                          item.get('album_art'),
+                                          item.get('uri')) for item in items],
+                                        separators = (',', ':')))
+        __sql = '''
+            INSERT OR REPLACE INTO queue_cache(
+                uid,
+                update_id,
+                total,
+                items,
+                updated
+            ) VALUES (?, ?, ?, ?, ?)
+        '''
+        logging.debug('Storing %d queue item(s) of "%s" (update id: %s)', len(items), speaker, updateId)
+        self._writer.execute(__sql, (uid, updateId, total, buffer(data), time.time()))
+
+    def getSpeakerState(self, speaker):
+        return self.__speakerStates.get(speaker.speaker_info.get('uid'))
+
+    @timed('db.getConfig')
+    def getConfig(self, settingName):
+        assert settingName is not None
+
+        __sql = 'SELECT value FROM config WHERE name = ? LIMIT 1'
+
+        with clib.closing(self._connection.execute(__sql, (settingName, ))) as cur:
+            row = cur.fetchone()
+
+            if not row:
+                return None
+            
+            return row['value']
+
+    @timed('db.setConfig')
+    def setConfig(self, settingName, value):
+        assert settingName is not None
+
+        __sql = 'INSERT OR REPLACE INTO config (name, value) VALUES (?, ?)'
+
+        self._writer.execute(__sql, (settingName, value))
+
+    @timed('db.loadSpeakers')
+    def loadSpeakers(self):
+        logging.info('Loading speakers from config')
+        __sql = '''
+            SELECT
+                speaker_id,
+                name,
+                ip,
+                uid,
+                serial,
+                mac,
+                first_seen,
+                last_seen
+            FROM speakers
+        '''
+
+        self.__knownSpeakers = {}
+        speakers = []
+        with clib.closing(self._connection.execute(__sql)) as cur:
+            for row in cur:
+                speaker_id = None
+                try:
+                    speaker_id = row['speaker_id']
+                    speaker = WrappedSoCo(row['ip'], get_info = False)
+                    speaker.speaker_info['zone_name'] =         row['name']
+                    speaker.speaker_info['uid'] =               row['uid']
+                    speaker.speaker_info['serial_number'] =     row['serial']
+                    speaker.speaker_info['mac_address'] =       row['mac']
+                    speakers.append(speaker)
+
+                    self.__knownSpeakers[row['uid']] = {
+                        'values': (row['name'], row['ip'], row['serial'], row['mac']),
+                        'first_seen': row['first_seen'] or 0,
+                        'last_seen': row['last_seen'] or 0,
+                        'speaker': speaker,
+                        }
+                except:
+                    logging.error('Could not load speaker (id: %s)' % speaker_id)
+                    logging.error(traceback.format_exc())
+
+        return speakers
+
+    @timed('db.storeSpeakers')
+    def storeSpeakers(self, speakers):
+        # Speakers are keyed by uid and only what changed since the last
+        # scan is written. Speakers that did not answer are kept until they
+        # have not been seen for speakerMaxAge
+        if self.__knownSpeakers is None:
+            self.loadSpeakers()
+
+        now = time.time()
+        statements = []
+
+        __insert = '''
+            INSERT OR IGNORE INTO speakers(
+                name,
+                ip,
+                serial,
+                mac,
+                uid,
+                first_seen,
+                last_seen
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+        '''
+
+        __update = '''
+            UPDATE speakers SET
+                name = ?,
+                ip = ?,
+                serial = ?,
+                mac = ?,
+                last_seen = ?
+            WHERE uid = ?
+        '''
+
+        logging.debug('Storing speakers (size: %d)', len(speakers))
+        for speaker in speakers:
+            try:
+                uid = speaker.speaker_info['uid']
+                values = (
+                    speaker.speaker_info['zone_name'],
+                    speaker.speaker_ip,
+                    speaker.speaker_info['serial_number'],
+                    speaker.speaker_info['mac_address'],
+                    )
+            except:
+                logging.error('Could not store speaker: %s', speaker)
+                logging.error(traceback.format_exc())
+                continue
+
+            known = self.__knownSpeakers.get(uid)
+            if known is None:
+                # Updated first in case another process stored it since
+                # we loaded, the insert is then ignored
+                logging.info('New speaker: %s (%s)', speaker, speaker.speaker_ip)
+                statements.append((__update, values + (now, uid)))
+                statements.append((__insert, values + (uid, now, now)))
+                known = {'first_seen': now, 'last_seen': now}
+            elif known['values'] != values:
+                logging.info('Speaker changed: %s (%s)', speaker, speaker.speaker_ip)
+                statements.append((__update, values + (now, uid)))
+                known['last_seen'] = now
+            elif now - known['last_seen'] >= self.speakerSeenResolution:
+                statements.append(('UPDATE speakers SET last_seen = ? WHERE uid = ?', (now, uid)))
+                known['last_seen'] = now
+
+            known['values'] = values
+            known['speaker'] = speaker
+            self.__knownSpeakers[uid] = known
+
+        expired = [uid for uid, known in self.__knownSpeakers.items()
+                   if known['last_seen'] < now - self.speakerMaxAge]
+        if expired:
+            logging.info('Forgetting %d speaker(s) not seen for %d day(s)',
+                         len(expired), self.speakerMaxAge // (24 * 3600))
+            statements.append(('DELETE FROM speakers WHERE last_seen < ?', (now - self.speakerMaxAge,)))
+            for table in ('speaker_state', 'queue_cache'):
+                statements.append(('DELETE FROM %s WHERE uid NOT IN (SELECT uid FROM speakers)' % table, ()))
+            for uid in expired:
+                del self.__knownSpeakers[uid]
+
+        if statements:
+            self._writer.transaction(statements)
+
+    @timed('db.loadSpeakerStates')
+    def loadSpeakerStates(self):
+        __sql = '''
+            SELECT
+                uid,
+                title,
+                artist,
+                album,
+                album_art,
+                uri
+            FROM speaker_state
+        '''
+
+        self.__speakerStates = {}
+        with clib.closing(self._connection.execute(__sql)) as cur:
+            for row in cur:
+                self.__speakerStates[row['uid']] = dict((info, row[info]) for info in
+                                                        ('title', 'artist', 'album', 'album_art', 'uri'))
+
+    @timed('db.storeSpeakerState')
+    def storeSpeakerState(self, speaker, track):
+        uid = speaker.speaker_info.get('uid')
+        if uid is None:
+            return
+
+        old = self.__speakerStates.get(uid, {})
+        state = dict(old)
+        for info in ('title', 'artist', 'album', 'album_art', 'uri'):
+            if info in track:
+                state[info] = track[info]
+
+        if state == old:
+            return
+
+        self.__speakerStates[uid] = state
+        __sql = '''
+            INSERT OR REPLACE INTO speaker_state(
+                uid,
+                title,
+                artist,
+                album,
+                album_art,
+                uri,
+                updated
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+        '''
+
+        self._writer.execute(__sql, (uid,
+                                     state.get('title'),
+                                     state.get('artist'),
+                                     state.get('album'),
+                                     state.get('album_art'),
+                                     state.get('uri'),
+                                     time.time()))
+
+    def _createSettingsDB(self):
+        logging.debug('Creating tables')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS config(
+                config_id   INTEGER,
+                name        TEXT UNIQUE,
+                value       TEXT,
+                PRIMARY KEY(config_id)
+            );
+                
+            CREATE TABLE IF NOT EXISTS speakers(
+                speaker_id  INTEGER,
+                name        TEXT,
+                ip          TEXT,
+                uid         TEXT,
+                serial      TEXT,
+                mac         TEXT,
+                PRIMARY KEY(speaker_id)
+            );
+                
+            CREATE TABLE IF NOT EXISTS images(
+                image_id        INTEGER,
+                uri             TEXT UNIQUE,
+                image           BLOB,
+                PRIMARY KEY(image_id)
+            );
+        ''').close()
+
+        logging.debug('Creating index')
+        self._connection.execute('''
+            CREATE INDEX IF NOT EXISTS idx_image_uri ON images(uri)
+        ''').close()
+
+        self._connection.execute('''
+            CREATE INDEX IF NOT EXISTS idx_config_name ON config(name)
+        ''').close()
+
+    def _upgradeSettingsDB(self):
+        # Every step brings the schema one version further, the current
+        # version is kept in the database itself (PRAGMA user_version)
+        upgrades = [
+            self.__createThumbnailTable,
+            self.__createArtStore,
+            self.__addArtAccessTime,
+            self.__keySpeakersByUid,
+            self.__createSpeakerState,
+            self.__createQueueCache,
+            ]
+
+        with clib.closing(self._connection.execute('PRAGMA user_version')) as cur:
+            version = cur.fetchone()[0]
+
+        # A step commits together with its version number, an interrupted
+        # upgrade is rolled back and starts that step over on the next open
+        isolation_level = self._connection.isolation_level
+        self._connection.isolation_level = None
+        try:
+            for index, upgrade in enumerate(upgrades[version:], version + 1):
+                logging.info('Upgrading database to version %d', index)
+                self._connection.execute('BEGIN').close()
+                try:
+                    upgrade()
+                    self._connection.execute('PRAGMA user_version = %d' % index).close()
+                except:
+                    self._connection.execute('ROLLBACK').close()
+                    raise
+                self._connection.execute('COMMIT').close()
+        finally:
+            self._connection.isolation_level = isolation_level
+
+    def __executeStatements(self, script):
+        # executescript() commits first, these have to stay inside the
+        # upgrade's transaction
+        for statement in script.split(';'):
+            if statement.strip():
+                self._connection.execute(statement).close()
+
+    def __createThumbnailTable(self):
+        self.__executeStatements('''
+            CREATE TABLE IF NOT EXISTS thumbnails(
+                thumbnail_id    INTEGER,
+                uri             TEXT,
+                width           INTEGER,
+                height          INTEGER,
+                image           BLOB,
+                PRIMARY KEY(thumbnail_id),
+                UNIQUE(uri, width, height)
+            );
+        ''')
+
+    def __createArtStore(self):
+        self.__executeStatements('''
+            CREATE TABLE IF NOT EXISTS art(
+                art_id          INTEGER,
+                hash            TEXT UNIQUE,
+                image           BLOB,
+                PRIMARY KEY(art_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS art_sources(
+                source          TEXT,
+                hash            TEXT,
+                PRIMARY KEY(source)
+            );
+
+            CREATE TABLE IF NOT EXISTS track_art(
+                uri             TEXT,
+                hash            TEXT,
+                PRIMARY KEY(uri)
+            );
+
+            ALTER TABLE thumbnails RENAME TO thumbnails_by_uri;
+
+            CREATE TABLE thumbnails(
+                thumbnail_id    INTEGER,
+                hash            TEXT,
+                width           INTEGER,
+                height          INTEGER,
+                image           BLOB,
+                PRIMARY KEY(thumbnail_id),
+                UNIQUE(hash, width, height)
+            );
+        ''')
+
+        # Originals keyed by track uri become one art row per distinct
+        # image, the track uri is kept as a mapping to it
+        logging.info('Moving album art to content addressed store')
+        with clib.closing(self._connection.execute('SELECT uri, image FROM images')) as cur:
+            for row in cur:
+                raw_data = str(row['image'])
+                art_hash = hashlib.sha1(raw_data).hexdigest()
+
+                self._connection.execute('INSERT OR IGNORE INTO art (hash, image) VALUES (?, ?)',
+                                         (art_hash, buffer(raw_data))).close()
+                if row['uri']:
+                    self._connection.execute('INSERT OR REPLACE INTO track_art (uri, hash) VALUES (?, ?)',
+                                             (row['uri'], art_hash)).close()
+
+        # Thumbnails follow their track, those without an original are
+        # addressed by the hash of the thumbnail itself
+        __sql = 'SELECT uri, width, height, image FROM thumbnails_by_uri'
+        with clib.closing(self._connection.execute(__sql)) as cur:
+            for row in cur:
+                thumbnail = str(row['image'])
+
+                with clib.closing(self._connection.execute('SELECT hash FROM track_art WHERE uri = ?',
+                                                           (row['uri'],))) as lookup:
+                    mapping = lookup.fetchone()
+
+                if mapping:
+                    art_hash = mapping['hash']
+                else:
+                    art_hash = hashlib.sha1(thumbnail).hexdigest()
+                    self._connection.execute('INSERT OR IGNORE INTO art (hash, image) VALUES (?, NULL)',
+                                             (art_hash,)).close()
+                    self._connection.execute('INSERT OR REPLACE INTO track_art (uri, hash) VALUES (?, ?)',
+                                             (row['uri'], art_hash)).close()
+
+                self._connection.execute('''
+                    INSERT OR IGNORE INTO thumbnails (
+                        hash,
+                        width,
+                        height,
+                        image
+                    ) VALUES (?, ?, ?, ?)
+                ''', (art_hash, row['width'], row['height'], buffer(thumbnail))).close()
+
+        self.__executeStatements('''
+            DROP TABLE thumbnails_by_uri;
+            DELETE FROM images;
+        ''')
+
+    def __addArtAccessTime(self):
+        self.__executeStatements('''
+            ALTER TABLE art ADD COLUMN last_access REAL DEFAULT 0;
+
+            CREATE INDEX IF NOT EXISTS idx_art_last_access ON art(last_access);
+            CREATE INDEX IF NOT EXISTS idx_track_art_hash ON track_art(hash);
+            CREATE INDEX IF NOT EXISTS idx_art_sources_hash ON art_sources(hash);
+        ''')
+
+    def __keySpeakersByUid(self):
+        # Older versions stored every scan from scratch, rows already there
+        # count as seen now so they do not age out right away
+        self._connection.execute('''
+            DELETE FROM speakers
+            WHERE speaker_id NOT IN (SELECT MAX(speaker_id) FROM speakers GROUP BY uid)
+        ''').close()
+
+        self.__executeStatements('''
+            ALTER TABLE speakers ADD COLUMN first_seen REAL;
+            ALTER TABLE speakers ADD COLUMN last_seen REAL;
+
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_speakers_uid ON speakers(uid);
+        ''')
+
+        now = time.time()
+        self._connection.execute('UPDATE speakers SET first_seen = ?, last_seen = ?',
+                                 (now, now)).close()
+
+    def __createSpeakerState(self):
+        self.__executeStatements('''
+            CREATE TABLE IF NOT EXISTS speaker_state(
+                uid             TEXT,
+                title           TEXT,
+                artist          TEXT,
+                album           TEXT,
+                album_art       TEXT,
+                uri             TEXT,
+                updated         REAL,
+                PRIMARY KEY(uid)
+            );
+        ''')
+
+    def __createQueueCache(self):
+        self.__executeStatements('''
+            CREATE TABLE IF NOT EXISTS queue_cache(
+                uid             TEXT,
+                update_id       INTEGER,
+                total           INTEGER,
+                items           BLOB,
+                updated         REAL,
+                PRIMARY KEY(uid)
+            );
+        ''')
+
+
+def _printTrack(speaker, track):
+    print '%-20s %-15s %s - %s (volume: %s)' % (
+        speaker,
+        speaker.speaker_ip,
+        track.get('artist') or '-',
+        track.get('title') or '-',
+        track.get('volume'))
+
+def main(argv = None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Control Sonos speakers without the SoCo-Tk window')
+    parser.add_argument('--db', help = 'settings database, the one of SoCo-Tk by default')
+    parser.add_argument('--time', action = 'store_true', help = 'print how long the command took')
+    parser.add_argument('--timings', metavar = 'FILE', help = 'save latencies of every call made as json')
+    parser.add_argument('--verbose', '-v', action = 'store_true', help = 'log everything')
+    commands = parser.add_subparsers(dest = 'command')
+
+    command = commands.add_parser('scan', help = 'find the speakers on the network and remember them')
+    command.add_argument('--timeout', type = float, default = 5.0, help = 'seconds to wait for a speaker')
+    command.add_argument('--workers', type = int, default = 32, help = 'speakers probed at once')
+
+    command = commands.add_parser('status', help = 'show what speakers are playing')
+    command.add_argument('speakers', nargs = '*', help = 'names, ips or uids, all known speakers by default')
+
+    command = commands.add_parser('queue', help = 'list the queue of a speaker')
+    command.add_argument('speaker', nargs = '?', help = 'name, ip or uid, the last selected one by default')
+    command.add_argument('--start', type = int, default = 0, help = 'first item')
+    command.add_argument('--count', type = int, default = 100, help = 'number of items')
+
+    for name, description in (('play', 'start playing'),
+                              ('pause', 'pause playback'),
+                              ('next', 'skip to the next track'),
+                              ('previous', 'go back to the previous track')):
+        command = commands.add_parser(name, help = description)
+        command.add_argument('speakers', nargs = '*', help = 'names, ips or uids, the last selected one by default')
+        if name == 'play':
+            command.add_argument('--index', type = int, help = 'queue item to play (0 based)')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(format = '%(asctime)s %(levelname)10s: %(message)s',
+                        level = logging.DEBUG if args.verbose else logging.WARNING)
+
+    if not findSoCo():
+        print >> sys.stderr, 'Could not find SoCo library, make sure you have installed SoCo!'
+        return 1
+
+    controller = SonosController()
+    controller.open(args.db)
+    if args.timings:
+        TIMINGS.enabled = True
+
+    started = time.time()
+    try:
+        return _runCommand(controller, args)
+    finally:
+        if args.time:
+            print >> sys.stderr, '%s: %.1f ms' % (args.command, (time.time() - started) * 1000)
+        controller.close()
+        if args.timings:
+            TIMINGS.export(args.timings)
+
+def _runCommand(controller, args):
+    if args.command == 'scan':
+        speakers = controller.scan(args.timeout, args.workers)
+        controller.storeSpeakers(speakers)
+        for speaker in speakers:
+            print '%-20s %-15s %s' % (speaker, speaker.speaker_ip, speaker.speaker_info.get('uid'))
+        return 0
+
+    known = controller.loadSpeakers()
+    names = getattr(args, 'speakers', None)
+    if names is None:
+        names = [args.speaker] if args.speaker else []
+
+    if names:
+        speakers = []
+        for name in names:
+            speaker = controller.findSpeaker(known, name)
+            if speaker is None:
+                print >> sys.stderr, 'Unknown speaker: %s (try scan first)' % name
+                return 2
+            speakers.append(speaker)
+    elif args.command == 'status':
+        speakers = known
+    else:
+        speaker = controller.findSpeaker(known, controller.getConfig('last_selected') or '')
+        if speaker is None:
+            print >> sys.stderr, 'No speaker given and none selected in SoCo-Tk'
+            return 2
+        speakers = [speaker]
+
+    if args.command == 'queue':
+        speaker = speakers[0]
+        for index, item in enumerate(controller.getQueue(speaker, args.start, args.count), args.start):
+            print '%5d  %s - %s' % (index, item.get('artist') or '-', item.get('title') or '-')
+        return 0
+
+    if args.command == 'status':
+        func = controller.getTrackInfo
+    elif args.command == 'play' and args.index is not None:
+        func = lambda speaker: controller.runCommand(speaker, 'play_from_queue', args.index)
+    else:
+        func = lambda speaker: controller.runCommand(speaker, args.command)
+
+    failed = 0
+    for speaker, result, errmsg in controller.runAll(func, speakers):
+        if errmsg is not None:
+            failed += 1
+            print >> sys.stderr, '%s: failed' % speaker
+            logging.error(errmsg)
+        elif args.command == 'status':
+            controller.storeSpeakerState(speaker, result)
+            _printTrack(speaker, result)
+        else:
+            print '%s: ok' % speaker
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+# Event subscriptions against a fake speaker from fake_sonos.py: the
+# listener subscribes, the speaker sends its NOTIFYs back and we check
+# what comes out of parseEvent and what SonosList does with it. Run with
+#
+#     python -m unittest discover
+
+import os, sys
+import imp
+import types
+import Queue
+import unittest
+
+import fake_sonos
+from soco_controller import EventListener, HTTP_POOL, WrappedSoCo, findSoCo, parseEvent
+
+
+class EventListenerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.speaker = fake_sonos.startSpeakers(1, queueSize = 30)[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        # Kept alive connections would keep the speaker's threads busy
+        HTTP_POOL.closeIdle()
+        fake_sonos.stopSpeakers([cls.speaker])
+
+    def setUp(self):
+        self.events = Queue.Queue()
+        self.listener = EventListener(lambda sid, service, seq, changes:
+                                      self.events.put((sid, service, seq, changes)))
+        self.listener.start()
+
+    def tearDown(self):
+        self.listener.stop()
+        self.speaker.subscriptions.clear()
+
+    def nextEvent(self):
+        return self.events.get(timeout = 5)
+
+    def assertNoEvent(self):
+        self.assertRaises(Queue.Empty, self.events.get, timeout = 0.5)
+
+    def subscribe(self, service):
+        sid, timeout = self.listener.subscribe(self.speaker.ip, service)
+        self.assertIn(sid, self.speaker.subscriptions)
+        self.assertEqual(timeout, 1800)
+        return sid
+
+    def testTransport(self):
+        sid = self.subscribe('transport')
+        self.speaker.position = 12
+
+        self.assertEqual(self.speaker.notify('transport'), 1)
+        eventSid, service, seq, changes = self.nextEvent()
+
+        item = self.speaker.queue[12]
+        self.assertEqual((eventSid, service, seq), (sid, 'transport', '0'))
+        self.assertEqual(changes.keys(), ['track'])
+        self.assertEqual(changes['track'], {
+            'uri': item['uri'],
+            'title': item['title'],
+            'artist': item['artist'],
+            'album': item['album'],
+            'album_art': 'http://%s:1400%s' % (self.speaker.ip, item['album_art']),
+            })
+
+    def testRendering(self):
+        sid = self.subscribe('rendering')
+        self.speaker.volume = 37
+
+        self.speaker.notify('rendering')
+        self.assertEqual(self.nextEvent(), (sid, 'rendering', '0', {'volume': 37}))
+
+    def testQueue(self):
+        sid = self.subscribe('queue')
+
+        self.speaker.notify('queue')
+        self.assertEqual(self.nextEvent(), (sid, 'queue', '0', {'queue': True}))
+
+        self.speaker.setQueue(20)
+        self.speaker.notify('queue')
+        self.assertEqual(self.nextEvent(), (sid, 'queue', '1', {'queue': True}))
+
+    def testServicesStaySeparate(self):
+        transport = self.subscribe('transport')
+        rendering = self.subscribe('rendering')
+
+        self.speaker.notify('rendering')
+        self.assertEqual(self.nextEvent()[:2], (rendering, 'rendering'))
+        self.assertNoEvent()
+
+        self.speaker.notify('transport')
+        self.assertEqual(self.nextEvent()[:2], (transport, 'transport'))
+
+    def testUnknownSubscription(self):
+        # Subscribed behind the listener's back, it never heard of the sid
+        callback = '<http://127.0.0.1:%d/notify/rendering>' % self.listener.port
+        self.speaker.subscribe('rendering', callback, 'Second-1800')
+
+        self.assertEqual(self.speaker.notify('rendering'), 1)
+        self.assertNoEvent()
+
+    def testUnsubscribe(self):
+        sid = self.subscribe('queue')
+        self.listener.unsubscribe(self.speaker.ip, 'queue', sid)
+
+        self.assertNotIn(sid, self.speaker.subscriptions)
+        self.assertEqual(self.speaker.notify('queue'), 0)
+
+    def testRenew(self):
+        sid = self.subscribe('transport')
+        self.speaker.subscriptions[sid]['timeout'] = None
+
+        self.assertEqual(self.listener.renew(self.speaker.ip, 'transport', sid), 1800)
+        self.assertEqual(self.speaker.subscriptions[sid]['timeout'], 'Second-1800')
+
+        self.speaker.notify('transport')
+        self.assertEqual(self.nextEvent()[:3], (sid, 'transport', '0'))
+
+    def testRenewExpired(self):
+        sid = self.subscribe('transport')
+        del self.speaker.subscriptions[sid]
+
+        self.assertRaises(IOError, self.listener.renew, self.speaker.ip, 'transport', sid)
+
+
+class ParseEventTest(unittest.TestCase):
+    def setUp(self):
+        self.speaker = fake_sonos.FakeSpeaker('127.0.0.1', queueSize = 3)
+
+    def testOtherChannels(self):
+        # Only the master volume counts, LF is sent along with it
+        self.speaker.volume = 5
+        self.assertEqual(parseEvent('rendering', self.speaker.eventBody('rendering'), self.speaker.ip),
+                         {'volume': 5})
+
+    def testEmptyQueue(self):
+        self.speaker.setQueue(0)
+        changes = parseEvent('transport', self.speaker.eventBody('transport'), self.speaker.ip)
+        self.assertEqual(changes, {'track': {'uri': '', 'title': '', 'artist': '', 'album': '', 'album_art': ''}})
+
+    def testContentDirectory(self):
+        body = '<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0"><e:property>'\
+               '<ContainerUpdateIDs>Q:0,7</ContainerUpdateIDs></e:property>'\
+               '<e:property><SystemUpdateID>12</SystemUpdateID></e:property></e:propertyset>'
+        self.assertEqual(parseEvent('content', body, self.speaker.ip), {'queue': True})
+
+        body = body.replace('Q:0,7', 'S:,3')
+        self.assertEqual(parseEvent('content', body, self.speaker.ip), {})
+
+
+class EventReceivedTest(unittest.TestCase):
+    # SonosList.__eventReceived without Tk, the calls it makes are recorded
+    @classmethod
+    def setUpClass(cls):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SoCo-tk.py')
+        cls.module = imp.load_source('soco_tk', path)
+
+    def setUp(self):
+        self.calls = []
+        self.speaker = WrappedSoCo('127.0.0.1', get_info = False)
+
+        view = types.InstanceType(self.module.SonosList)
+        view.destroy = lambda: None
+        view._SonosList__currentSpeaker = self.speaker
+        view._SonosList__subscribedSpeaker = self.speaker
+        view._SonosList__subscriptions = {'transport': 'sid-t', 'rendering': 'sid-r', 'queue': 'sid-q'}
+        view._SonosList__showVolume = lambda speaker, volume: self.calls.append(('volume', volume))
+        view._SonosList__showTrackInfo = lambda speaker, track: self.calls.append(('track', track['title']))
+        view.refreshQueue = lambda: self.calls.append(('queue',))
+        self.view = view
+
+    def receive(self, sid, service, seq, changes):
+        self.view._SonosList__eventReceived(sid, service, seq, changes)
+        return self.calls
+
+    def testVolume(self):
+        self.assertEqual(self.receive('sid-r', 'rendering', '3', {'volume': 12}), [('volume', 12)])
+
+    def testTrack(self):
+        track = {'uri': 'x', 'title': 'Song', 'artist': '', 'album': '', 'album_art': ''}
+        self.assertEqual(self.receive('sid-t', 'transport', '1', {'track': track}), [('track', 'Song')])
+
+    def testTrackWithoutMetaData(self):
+        # A uri alone is not enough to show anything
+        self.assertEqual(self.receive('sid-t', 'transport', '1', {'track': {'uri': 'x'}}), [])
+
+    def testFirstQueueEvent(self):
+        # seq 0 only repeats what was just loaded
+        self.assertEqual(self.receive('sid-q', 'queue', '0', {'queue': True}), [])
+        self.assertEqual(self.receive('sid-q', 'queue', '1', {'queue': True}), [('queue',)])
+
+    def testOtherSubscription(self):
+        self.assertEqual(self.receive('sid-old', 'rendering', '1', {'volume': 12}), [])
+
+    def testOtherSpeaker(self):
+        self.view._SonosList__currentSpeaker = WrappedSoCo('127.0.0.2', get_info = False)
+        self.assertEqual(self.receive('sid-r', 'rendering', '1', {'volume': 12}), [])
+
+
+if __name__ == '__main__':
+    if not findSoCo():
+        print >> sys.stderr, 'Could not find SoCo library, make sure you have installed SoCo!'
+        sys.exit(1)
+
+    unittest.main()